@@ -1,7 +1,8 @@
 from dataclasses import dataclass
 from ultralytics import YOLO
 from picam import Camera
-from detect import detect
+from artifacts import ArtifactWriter
+from detect import detect_array
 from typing import Any
 from time import sleep
 from enum import Enum
@@ -9,6 +10,15 @@ from log import logger
 import traceback
 import requests
 import json
+import cv2
+
+
+READINGS_BATCH_MAX = 1000
+# Oldest readings are dropped beyond this, a device can be cut off from the server for a long time
+UNSENT_READINGS_MAX = 10 * READINGS_BATCH_MAX
+# Encoded frames are much larger than readings, so only the newest ones are kept while the server is unreachable
+UNSENT_FRAMES_MAX = 100
+FAILED_BATCH_BACKOFF_MAX_SEC = 300
 
 
 class Application:
@@ -22,16 +32,27 @@ class Application:
         reading: str = ''
         filename: str = ''
         timestamp: str = ''
+        image: Any = None  # Annotated frame to upload, or the encoded capture until the server has read it
 
     def __init__(self):
         self.config = json.loads(open('device.json', 'r').read())
 
         self.camera = Camera()
-        self.model = YOLO(self.config['model']['path'], task='detect')
+        # Low-end devices can leave inference to the server and only upload frames
+        self.server_inference = self.config['model'].get('server_inference', False)
+        self.model = None if self.server_inference else YOLO(self.config['model']['path'], task='detect')
+        # Frames stay in memory, captures are only written to the SD card for debugging
+        self.artifacts = ArtifactWriter() if self.config['model'].get('save_artifacts', False) else None
 
         self.state = Application.State.UNREGISTERED
         self.fetch_delay = self.config['server']['fetch_delay']
+        self.long_poll = self.config['server'].get('long_poll', 0)
+        self.polled = False
+        self.next_poll: float | None = None
+        self.failed_batches = 0
         self.last_reading = Application.ReadingData()
+        self.unsent_readings: list[Application.ReadingData] = []
+        self.unsent_frames: list[Application.ReadingData] = []
         self.send_image = False
 
         logger.info(f'delay: {self.fetch_delay}')
@@ -50,34 +71,147 @@ class Application:
         )
 
     def get_reading(self) -> ReadingData:
-        capture = self.camera.capture()
-        logger.info(f'Capture: {capture.filename}')
+        frame = self.camera.capture_array()
+        logger.info(f'Capture: {frame.timestamp}')
 
-        result = detect(
-            capture.filename,
+        result, annotated = detect_array(
+            frame.image,
             self.model,
             self.config['model']['conf'],
             self.config['model']['imagesize'],
-            self.config['model']['img_scale_method']
+            self.config['model']['img_scale_method'],
+            annotate=self.send_image or self.artifacts is not None
         )
 
+        filename = ''
+        if self.artifacts:
+            filename = self.artifacts.save(f'capture_{frame.timestamp}.jpg', frame.image)
+            if annotated is not None:
+                self.artifacts.save(f'capture_{frame.timestamp}_detect.jpg', annotated)
+
         logger.info(f'Scan result: {result}')
-        return Application.ReadingData(result, capture.filename, capture.timestamp)
+        return Application.ReadingData(result, filename, frame.timestamp, annotated if self.send_image else None)
+
+    def get_server_reading(self) -> ReadingData | None:
+        frame = self.camera.capture_array()
+        logger.info(f'Capture: {frame.timestamp}')
+
+        encoded, image = cv2.imencode('.jpg', frame.image)
+        if not encoded:
+            logger.error('Failed to encode frame')
+            return None
+
+        filename = self.artifacts.save(f'capture_{frame.timestamp}.jpg', frame.image) if self.artifacts else ''
+        reading = Application.ReadingData(filename=filename, timestamp=frame.timestamp, image=image.tobytes())
+
+        sent = self.send_frame(reading)
+        if sent is None:
+            if len(self.unsent_frames) >= UNSENT_FRAMES_MAX:
+                dropped = self.unsent_frames.pop(0)
+                logger.warning(f'Dropped unsent frame {dropped.timestamp}')
+            self.unsent_frames.append(reading)
+            logger.warning(f'Failed to send frame, {len(self.unsent_frames)} pending')
+
+        return reading if sent else None
+
+    def send_frame(self, reading: ReadingData) -> bool | None:
+        # None when the frame should be sent again later, False when the server rejected it
+        try:
+            response = requests.post(
+                self.construct_request_url(
+                    '/api/rpi/send_frame',
+                    {'id': self.config['device']['id'], 'time': reading.timestamp}
+                ),
+                data=reading.image,
+                headers={'Content-Type': 'image/jpeg'}
+            )
+        except requests.RequestException as e:
+            logger.error(f'Exception: {e}')
+            return None
+
+        if response.status_code != 200:
+            logger.error(f'[api/rpi/send_frame]: {response.status_code}')
+            logger.debug(f'                      {response.text}')
+            # Sending a frame the server rejected again will not change its mind
+            return False if 400 <= response.status_code < 500 else None
+
+        reading.reading = json.loads(response.text)['reading']
+        reading.image = None
+
+        logger.info(f'Server scan result: {reading.reading}')
+        return True
+
+    def send_unsent_frames(self):
+        logger.info(f'Send {len(self.unsent_frames)} unsent frames')
+
+        # Oldest first, stops at the first failure so the order is kept for the next attempt
+        while self.unsent_frames:
+            if self.send_frame(self.unsent_frames[0]) is None:
+                return
+            self.unsent_frames.pop(0)
 
     def send_reading(self, reading: ReadingData):
         logger.info(f'Send readings: "{reading.reading}" ({reading.timestamp})')
-        requests.post(
-            self.construct_request_url('/api/rpi/send_reading', {'id': self.config['device']['id']}),
-            json={'reading': reading.reading, 'time': reading.timestamp},
-        )
-
-        if self.send_image:
-            detect_filename = reading.filename.replace('.jpg', '_detect.jpg')
-            logger.info(f'Send image: {detect_filename}')
-            requests.post(
-                self.construct_request_url('/api/rpi/send_detect_image'),
-                files={'image': open(detect_filename, 'rb')}
+        try:
+            response = requests.post(
+                self.construct_request_url('/api/rpi/send_reading', {'id': self.config['device']['id']}),
+                json={'reading': reading.reading, 'time': reading.timestamp},
+            )
+            # Sending a reading the server rejected again will not change its mind
+            retry = response.status_code >= 500
+            if response.status_code != 200:
+                logger.error(f'[api/rpi/send_reading]: {response.status_code}')
+                logger.debug(f'                        {response.text}')
+        except requests.RequestException as e:
+            logger.error(f'Exception: {e}')
+            retry = True
+
+        if retry:
+            if len(self.unsent_readings) >= UNSENT_READINGS_MAX:
+                dropped = self.unsent_readings.pop(0)
+                logger.warning(f'Dropped unsent reading {dropped.timestamp}')
+            self.unsent_readings.append(reading)
+            logger.warning(f'Failed to send reading, {len(self.unsent_readings)} pending')
+
+        if self.send_image and reading.image is not None:
+            encoded, image = cv2.imencode('.jpg', reading.image)
+            logger.info(f'Send image: {reading.timestamp}')
+            if encoded:
+                requests.post(
+                    self.construct_request_url(
+                        '/api/rpi/send_detect_image',
+                        {'id': self.config['device']['id'], 'time': reading.timestamp}
+                    ),
+                    files={'image': (f'capture_{reading.timestamp}_detect.jpg', image.tobytes(), 'image/jpeg')}
+                )
+            # Readings can wait in unsent_readings for a long time, the frame should not wait with them
+            reading.image = None
+
+    def send_unsent_readings(self):
+        batch = self.unsent_readings[:READINGS_BATCH_MAX]
+        logger.info(f'Send {len(batch)} unsent readings')
+
+        try:
+            response = requests.post(
+                self.construct_request_url('/api/rpi/send_readings', {'id': self.config['device']['id']}),
+                json=[{'reading': reading.reading, 'time': reading.timestamp} for reading in batch],
             )
+        except requests.RequestException as e:
+            logger.error(f'Exception: {e}')
+            return
+
+        if response.status_code != 200:
+            logger.error(f'[api/rpi/send_readings]: {response.status_code}')
+            logger.debug(f'                         {response.text}')
+            if response.status_code >= 500:
+                return
+            # Rejected batch would block everything queued behind it
+            logger.warning(f'Dropped {len(batch)} unsent readings')
+        elif invalid := json.loads(response.text).get('invalid'):
+            logger.warning(f'Server skipped {invalid} readings with an invalid time')
+
+        # Server ignores readings it already has, so a retried batch is harmless
+        del self.unsent_readings[:len(batch)]
 
     def get_settings(self):
         logger.info('Requesting settings')
@@ -120,7 +254,19 @@ class Application:
                 logger.info(f'Unknown status: {payload["status"]}')
 
     def idle(self):
-        response = requests.get(self.construct_request_url('/api/rpi/fetch', {'id': self.config['device']['id']}))
+        if self.unsent_readings:
+            self.send_unsent_readings()
+        if self.unsent_frames:
+            self.send_unsent_frames()
+
+        url_params = {'id': self.config['device']['id'], 'batch': 1}
+        if self.long_poll:
+            url_params['wait'] = self.long_poll
+
+        response = requests.get(
+            self.construct_request_url('/api/rpi/fetch', url_params),
+            timeout=self.long_poll + self.fetch_delay if self.long_poll else None
+        )
 
         if response.status_code != 200:
             logger.error(f'[api/rpi/fetch]: {response.status_code}')
@@ -128,35 +274,92 @@ class Application:
             return
 
         payload = json.loads(response.text)
+        self.polled = bool(self.long_poll)
+        self.next_poll = payload.get('next_poll')
 
         if 'command' in payload:
-            if payload['command'] == 'idle':
-                ...
-            elif payload['command'] == 'get_reading':
-                self.state = Application.State.CAPTURING
-            elif payload['command'] == 'register':
-                logger.warning('Unregistered')
-                self.state = Application.State.UNREGISTERED
-            elif payload['command'] == 'set_settings':
-                logger.info('Receiving settings')
-                self.fetch_delay = int(payload['timeout'])
-                logger.info(f'New fetch_delay: {self.fetch_delay}s')
-            elif payload['command'] == 'resend_last':
-                logger.info('Resend last reading')
-                self.send_reading(self.last_reading)
+            if payload['command'] == 'batch':
+                self.execute_batch(payload['commands'])
             else:
-                logger.error(f'Unknown command: {payload["command"]}')
+                self.execute_command(payload)
+
+    def execute_batch(self, commands: list[dict]):
+        logger.info(f'Received {len(commands)} commands')
+        executed = []
+
+        for command in commands:
+            try:
+                self.execute_command(command)
+                if self.state == Application.State.CAPTURING:
+                    self.capture()
+            except Exception as e:
+                # Commands that were not acked are handed out again on the next fetch
+                logger.error(f'Command {command["command"]} failed: {e}')
+                break
+            executed.append(command['id'])
+
+        if executed:
+            self.ack(executed)
+
+        if len(executed) == len(commands):
+            self.failed_batches = 0
+            return
+
+        # Server hands the same batch out right away, so the next fetch waits longer after every failure
+        self.failed_batches += 1
+        self.next_poll = min(max(self.fetch_delay, 1) * 2 ** (self.failed_batches - 1), FAILED_BATCH_BACKOFF_MAX_SEC)
+        logger.warning(f'Batch failed {self.failed_batches} times in a row, next fetch in {self.next_poll}s')
+
+    def execute_command(self, payload: dict):
+        if payload['command'] == 'idle':
+            ...
+        elif payload['command'] == 'get_reading':
+            self.state = Application.State.CAPTURING
+        elif payload['command'] == 'register':
+            logger.warning('Unregistered')
+            self.state = Application.State.UNREGISTERED
+        elif payload['command'] == 'set_settings':
+            logger.info('Receiving settings')
+            self.fetch_delay = int(payload['timeout'])
+            logger.info(f'New fetch_delay: {self.fetch_delay}s')
+        elif payload['command'] == 'resend_last':
+            if not self.last_reading.timestamp:
+                logger.warning('No reading to resend yet')
+                return
+            logger.info('Resend last reading')
+            self.send_reading(self.last_reading)
+        else:
+            logger.error(f'Unknown command: {payload["command"]}')
+
+    def ack(self, ids: list[int]):
+        response = requests.post(
+            self.construct_request_url('/api/rpi/ack', {'id': self.config['device']['id']}),
+            json={'ids': ids}
+        )
+
+        if response.status_code != 200:
+            logger.error(f'[api/rpi/ack]: {response.status_code}')
+            logger.debug(f'               {response.text}')
 
     def capture(self):
         logger.info('Start capturing')
 
-        reading = self.get_reading()
-        self.send_reading(reading)
+        if self.server_inference:
+            # Server stores the reading itself while answering the upload
+            reading = self.get_server_reading()
+            if reading:
+                self.last_reading = reading
+        else:
+            reading = self.get_reading()
+            self.last_reading = reading
+            self.send_reading(reading)
 
         self.state = Application.State.IDLE
 
     def run(self):
         while True:
+            self.polled = False
+            self.next_poll = None
             try:
                 if self.state == Application.State.IDLE:
                     self.idle()
@@ -173,4 +376,9 @@ class Application:
                 logger.info('Stop')
                 return
 
-            sleep(self.fetch_delay)
+            # Server knows whether anyone is waiting on this device, its hint wins over the fixed delay
+            if self.next_poll is not None:
+                sleep(self.next_poll)
+            # Server already held the long-poll open, so the next fetch can go out right away
+            elif not self.polled:
+                sleep(self.fetch_delay)
@@ -0,0 +1,38 @@
+from log import logger
+import threading
+import queue
+import cv2
+import os
+
+
+ARTIFACTS_DIR = 'captures'
+ARTIFACTS_QUEUE_SIZE = 8
+
+
+class ArtifactWriter:
+    # Writes images in the background, so a slow SD card does not hold up the next reading.
+    # When the card cannot keep up, images are dropped instead of piling up in memory.
+
+    def __init__(self, directory: str = ARTIFACTS_DIR):
+        self.directory = directory
+        self.queue: queue.Queue = queue.Queue(ARTIFACTS_QUEUE_SIZE)
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def save(self, name: str, image) -> str:
+        # Empty filename when the image was dropped, so no reading points at a file that never gets written
+        filename = os.path.join(self.directory, name)
+        try:
+            self.queue.put_nowait((filename, image))
+        except queue.Full:
+            logger.warning(f'Artifact queue is full, dropped {filename}')
+            return ''
+        return filename
+
+    def run(self):
+        while True:
+            filename, image = self.queue.get()
+            try:
+                cv2.imwrite(filename, image)
+            except Exception as e:
+                logger.error(f'Failed to write {filename}: {e}')
@@ -1,28 +1,37 @@
 from ultralytics import YOLO
 from functools import reduce
 from log import logger
+import numpy as np
 import cv2
 
 
-def detect(filename: str, model: YOLO, conf: float = 0.6, imgsize: int = 416, scale_method: str = 'resize') -> str:
-    capture = cv2.imread(filename)
-
+def preprocess(capture: np.ndarray, imgsize: int = 416, scale_method: str = 'resize') -> np.ndarray:
     if scale_method == 'resize':
-        resized = cv2.resize(capture, (imgsize, imgsize))
+        return cv2.resize(capture, (imgsize, imgsize))
     elif scale_method == 'crop':
         h, w, _ = capture.shape
         x = int((w - imgsize) / 2)
-        resized = capture[0:h, x:x+w]
-    else:
-        resized = capture
-
-    filename_resized = filename.replace('.jpg', '_resized.jpg')
-
-    cv2.imwrite(filename_resized, resized)
-
-    result = model(filename_resized, conf=conf, verbose=False, save=True, imgsz=imgsize)
+        return capture[0:h, x:x+w]
+    return capture
+
+
+def detect_array(
+    capture: np.ndarray,
+    model: YOLO,
+    conf: float = 0.6,
+    imgsize: int = 416,
+    scale_method: str = 'resize',
+    annotate: bool = False
+) -> tuple[str, np.ndarray | None]:
+    # Frame goes to the model as is, nothing is written to or read back from the SD card
+    resized = preprocess(capture, imgsize, scale_method)
+
+    result = model(resized, conf=conf, verbose=False, save=False, imgsz=imgsize)
     classes = []
 
+    # Boxes are drawn on a copy, so a crop does not scribble over the caller's frame
+    annotated = resized.copy() if annotate else None
+
     for box in result[0].boxes:
         x1 = int(box.xyxy[0][0].item())
         y1 = int(box.xyxy[0][1].item())
@@ -31,14 +40,19 @@ def detect(filename: str, model: YOLO, conf: float = 0.6, imgsize: int = 416, sc
         cls = int(box.cls)
         classes.append((x1, cls))
 
-        cv2.rectangle(resized, (x1, y1), (x2, y2), color=(0, 0, 255), thickness=2)
+        logger.debug(f'Detect: x={x1} cls={cls} conf={round(box.conf.item(), 2)}')
+
+        if annotated is None:
+            continue
+
+        cv2.rectangle(annotated, (x1, y1), (x2, y2), color=(0, 0, 255), thickness=2)
 
         font_scale = 0.5
         thickness = 1
         line_type = 2
 
         cv2.putText(
-            resized,
+            annotated,
             f'{int(round(box.conf.item(), 2) * 100)}',
             (x1, y1 - 10),
             cv2.FONT_HERSHEY_COMPLEX_SMALL,
@@ -49,7 +63,7 @@ def detect(filename: str, model: YOLO, conf: float = 0.6, imgsize: int = 416, sc
         )
 
         cv2.putText(
-            resized,
+            annotated,
             f'{cls}',
             (x1, y1 - 20),
             cv2.FONT_HERSHEY_COMPLEX_SMALL,
@@ -59,11 +73,12 @@ def detect(filename: str, model: YOLO, conf: float = 0.6, imgsize: int = 416, sc
             line_type
         )
 
-        logger.debug(f'Detect: x={x1} cls={cls} conf={round(box.conf.item(), 2)}')
-
-    cv2.imwrite(filename.replace('.jpg', '_detect.jpg'), resized)
-
     classes = sorted(classes, key=lambda e: e[0])
 
-    return reduce(lambda res, e: res + str(e[1]), classes, '')
+    return reduce(lambda res, e: res + str(e[1]), classes, ''), annotated
+
 
+def detect(filename: str, model: YOLO, conf: float = 0.6, imgsize: int = 416, scale_method: str = 'resize') -> str:
+    reading, annotated = detect_array(cv2.imread(filename), model, conf, imgsize, scale_method, annotate=True)
+    cv2.imwrite(filename.replace('.jpg', '_detect.jpg'), annotated)
+    return reading
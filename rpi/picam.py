@@ -2,6 +2,7 @@
 from dataclasses import dataclass
 from picamera2 import Picamera2
 from datetime import datetime
+import numpy as np
 import time
 
 
@@ -11,9 +12,15 @@ class Camera:
         filename: str = ''
         timestamp: str = ''
 
+    @dataclass
+    class Frame:
+        image: np.ndarray
+        timestamp: str = ''
+
     def __init__(self):
         self.camera = Picamera2()
-        camera_config = self.camera.create_preview_configuration()
+        # RGB888 is laid out as B, G, R, which is what OpenCV and the model expect from arrays
+        camera_config = self.camera.create_preview_configuration(main={'format': 'RGB888'})
 
         self.camera.configure(camera_config)
 
@@ -26,6 +33,11 @@ class Camera:
         self.camera.capture_file(filename)
         return Camera.Result(filename, timestamp)
 
+    def capture_array(self) -> Frame:
+        time.sleep(1)
+        timestamp = datetime.now().strftime('%d-%m-%Y_%H-%M-%S')
+        return Camera.Frame(self.camera.capture_array('main'), timestamp)
+
 
 if __name__ == '__main__':
     camera = Camera()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session
+from versions import versions
+from schemas import ReadingSchema, reading_schema
+from typing import Iterator, Iterable
+from models import Reading
+from log import logger
+import numpy as np
+import asyncio
+import shutil
+import sys
+import os
+
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', './archive')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_INTERVAL_SEC = 24 * 60 * 60
+ARCHIVE_CHUNK_SIZE = 10000
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Cold storage layout: ARCHIVE_DIR/<device_id>/<YYYY-MM>.npz, one compressed column per Reading field
+
+
+def device_dir(device_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, str(device_id))
+
+
+def month_path(device_id: int, month: datetime) -> str:
+    return os.path.join(device_dir(device_id), f'{month:%Y-%m}.npz')
+
+
+def to_micros(time: datetime) -> int:
+    return (time - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def load_month(path: str) -> dict[str, np.ndarray]:
+    with np.load(path) as data:
+        columns = {name: data[name] for name in data.files}
+
+    # Months archived before images were linked to readings
+    columns.setdefault('image_hash', np.full(len(columns['id']), '', dtype=np.str_))
+    return columns
+
+
+def write_month(path: str, columns: dict[str, np.ndarray]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, **columns)
+    os.replace(tmp, path)
+
+
+def rows_to_columns(readings: list) -> dict[str, np.ndarray]:
+    return {
+        'id': np.array([r.id for r in readings], dtype=np.int64),
+        'time': np.array([to_micros(r.time) for r in readings], dtype=np.int64),
+        'value': np.array([r.value if r.value is not None else 0 for r in readings], dtype=np.int64),
+        'has_value': np.array([r.value is not None for r in readings], dtype=bool),
+        'reading': np.array([r.reading or '' for r in readings], dtype=np.str_),
+        'image_hash': np.array([r.image_hash or '' for r in readings], dtype=np.str_),
+    }
+
+
+def merge_month(path: str, columns: dict[str, np.ndarray]):
+    if os.path.exists(path):
+        existing = load_month(path)
+        # Rows may already be there if a previous run crashed between writing and deleting
+        keep = ~np.isin(existing['id'], columns['id'])
+        columns = {name: np.concatenate([existing[name][keep], column]) for name, column in columns.items()}
+
+    order = np.lexsort((columns['id'], columns['time']))
+    write_month(path, {name: column[order] for name, column in columns.items()})
+
+
+def month_start(time: datetime) -> datetime:
+    return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def archive_device(session: Session, device_id: int, cutoff: datetime) -> int:
+    stmt = (
+        select(Reading.id, Reading.time, Reading.value, Reading.reading, Reading.image_hash)
+        .where(Reading.device_id == device_id)
+        .where(Reading.time < cutoff)
+        .order_by(Reading.time)
+        .execution_options(yield_per=ARCHIVE_CHUNK_SIZE)
+    )
+
+    # Rows come ordered by time, so only one month is held in memory at a time
+    count, month, readings, max_id = 0, None, [], 0
+    for reading in session.execute(stmt):
+        if month != month_start(reading.time):
+            if readings:
+                merge_month(month_path(device_id, month), rows_to_columns(readings))
+            month, readings = month_start(reading.time), []
+        readings.append(reading)
+        max_id = max(max_id, reading.id)
+        count += 1
+
+    if readings:
+        merge_month(month_path(device_id, month), rows_to_columns(readings))
+
+    if not count:
+        return 0
+
+    # Only the rows that made it into the files. Backlogged readings with old timestamps may have been
+    # inserted meanwhile, they got higher ids and wait for the next run instead of being deleted unarchived.
+    session.execute(
+        delete(Reading)
+        .where(Reading.device_id == device_id)
+        .where(Reading.time < cutoff)
+        .where(Reading.id <= max_id)
+    )
+    session.commit()
+    versions.readings_changed(device_id)
+
+    return count
+
+
+def archived_times(device_id: int, times: Iterable[datetime]) -> set[datetime]:
+    # Only months that have a file are loaded, which is rare outside of backlogs reaching far back
+    months = {}
+    for time in times:
+        months.setdefault(month_start(time), []).append(time)
+
+    archived = set()
+    for month, month_times in months.items():
+        path = month_path(device_id, month)
+        if not os.path.exists(path):
+            continue
+        stored = set(load_month(path)['time'].tolist())
+        archived.update(time for time in month_times if to_micros(time) in stored)
+
+    return archived
+
+
+def archive_readings(session: Session, cutoff: datetime) -> int:
+    stmt = select(Reading.device_id).where(Reading.time < cutoff).distinct()
+    return sum(archive_device(session, device_id, cutoff) for device_id in session.scalars(stmt).all())
+
+
+def month_overlaps(path: str, start: datetime | None, end: datetime | None) -> bool:
+    month = datetime.strptime(os.path.basename(path)[:7], '%Y-%m')
+    next_month = (month + timedelta(days=32)).replace(day=1)
+    return (start is None or next_month > start) and (end is None or month < end)
+
+
+def month_files(device_id: int, start: datetime | None, end: datetime | None) -> list[str]:
+    directory = device_dir(device_id)
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith('.npz') and not name.endswith('.tmp.npz')
+        and month_overlaps(os.path.join(directory, name), start, end)
+    )
+
+
+def filter_month(
+    columns: dict[str, np.ndarray],
+    start: datetime | None = None,
+    end: datetime | None = None,
+    after: tuple[datetime, int] | None = None
+) -> dict[str, np.ndarray]:
+    mask = np.ones(len(columns['id']), dtype=bool)
+    if start:
+        mask &= columns['time'] >= to_micros(start)
+    if end:
+        mask &= columns['time'] < to_micros(end)
+    if after:
+        after_time = to_micros(after[0])
+        mask &= (columns['time'] > after_time) | ((columns['time'] == after_time) & (columns['id'] > after[1]))
+
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def query_columns(
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    after: tuple[datetime, int] | None = None,
+    limit: int | None = None
+) -> dict[str, np.ndarray] | None:
+    if after and (start is None or after[0] > start):
+        start = after[0]
+
+    result = None
+    for path in month_files(device_id, start, end):
+        columns = filter_month(load_month(path), start, end, after)
+        result = columns if result is None else {
+            name: np.concatenate([result[name], column]) for name, column in columns.items()
+        }
+
+        # Months are read in order, so once enough rows are collected later months can be skipped
+        if limit is not None and len(result['id']) >= limit:
+            break
+
+    if result is None or len(result['id']) == 0:
+        return None
+
+    if limit is not None:
+        result = {name: column[:limit] for name, column in result.items()}
+
+    return result
+
+
+def column_rows(device_id: int, columns: dict[str, np.ndarray]) -> Iterator[tuple]:
+    # Same order as READING_FIELDS
+    for id, time, value, has_value, reading, image_hash in zip(
+        columns['id'], columns['time'], columns['value'], columns['has_value'],
+        columns['reading'], columns['image_hash']
+    ):
+        yield (
+            int(id), device_id, str(reading), int(value) if has_value else None,
+            from_micros(time), str(image_hash) or None
+        )
+
+
+def query_readings(
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    limit: int | None = None,
+    after: tuple[datetime, int] | None = None
+) -> list[ReadingSchema]:
+    columns = query_columns(device_id, start, end, after, limit)
+    if columns is None:
+        return []
+
+    return [reading_schema(row) for row in column_rows(device_id, columns)]
+
+
+def query_values(
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None
+) -> list[tuple[datetime, int]]:
+    columns = query_columns(device_id, start, end)
+    if columns is None:
+        return []
+
+    mask = columns['has_value']
+    return [
+        (from_micros(time), int(value)) for time, value in zip(columns['time'][mask], columns['value'][mask])
+    ]
+
+
+def max_archived_id() -> int:
+    if not os.path.isdir(ARCHIVE_DIR):
+        return 0
+
+    max_id = 0
+    for device in os.listdir(ARCHIVE_DIR):
+        for path in month_files(int(device), None, None) if device.isdigit() else []:
+            ids = load_month(path)['id']
+            if len(ids):
+                max_id = max(max_id, int(ids.max()))
+
+    return max_id
+
+
+def delete_device_archive(device_id: int):
+    shutil.rmtree(device_dir(device_id), ignore_errors=True)
+
+
+def run_archive(days: int = ARCHIVE_AFTER_DAYS) -> int:
+    from database import open_db_session
+
+    with open_db_session() as session:
+        return archive_readings(session, datetime.now() - timedelta(days=days))
+
+
+async def run():
+    while True:
+        try:
+            count = await run_in_threadpool(run_archive)
+            if count:
+                logger.info(f'Archive: moved {count} readings to {ARCHIVE_DIR}')
+        except Exception as e:
+            logger.error(f'Archive failed: {e!r}')
+
+        await asyncio.sleep(ARCHIVE_INTERVAL_SEC)
+
+
+def usage():
+    print(
+        'Usage: ./archive.py COMMAND [ARGS...]\n'
+        'Commands:\n'
+        f'    a|archive [DAYS] - Move readings older than DAYS (default {ARCHIVE_AFTER_DAYS}) to {ARCHIVE_DIR}\n'
+    )
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+        exit('Error: Invalid arguments')
+
+    if sys.argv[1] in ['a', 'archive']:
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else ARCHIVE_AFTER_DAYS
+        print(f'Archived {run_archive(days)} readings')
+    else:
+        usage()
+        exit('Error: Invalid arguments')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import select, delete, func
+from database import async_engine
+from datetime import datetime, timedelta
+from models import Notification, ServerState
+from presence import PRESENCE_FLUSH_INTERVAL_SEC
+from sqlalchemy.orm import Session
+from versions import versions
+from registry import registry
+from notify import notifier
+from events import events
+from writer import writer
+from log import logger
+from contextlib import contextmanager
+import asyncio
+import secrets
+import fcntl
+import json
+import os
+
+
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+
+BROKER_POLL_INTERVAL_SEC = float(os.environ.get('BROKER_POLL_INTERVAL_SEC', 0.05))
+BROKER_RETENTION_SEC = 60
+BROKER_LOCK_PATH = os.environ.get('BROKER_LOCK_PATH', './server.lock')
+BROKER_LEADER_RETRY_SEC = 5
+
+# Lets several server workers share one database. Changes are written to the notifications table and every
+# worker watches PRAGMA data_version, which only moves when another connection committed, so checking it is
+# free while nothing happens. Server options live in server_state instead of on a single worker's app.
+
+
+class Broker:
+    def __init__(self):
+        self.origin = secrets.token_hex(8)
+        self.last_id = 0
+        self.lock_file = None
+
+    def publish(self, session: Session, changes: set[tuple[str, int | None, str | None]]):
+        if not changes:
+            return
+        now = datetime.now()
+        session.execute(insert(Notification), [
+            {'origin': self.origin, 'kind': kind, 'device_id': device_id, 'payload': payload, 'created_time': now}
+            for kind, device_id, payload in changes
+        ])
+
+    async def set_state(self, key: str, value: str):
+        def store(session: Session):
+            stmt = insert(ServerState).values(key=key, value=value)
+            session.execute(stmt.on_conflict_do_update(index_elements=[ServerState.key], set_={'value': value}))
+            if versions.shared:
+                self.publish(session, {('state', None, None)})
+
+        await writer.submit(store)
+
+    async def load_state(self, conn, app):
+        state = dict((await conn.execute(select(ServerState.key, ServerState.value))).all())
+        if 'prod' in state:
+            app.prod = state['prod'] == 'true'
+
+    def apply(self, kind: str, device_id: int | None, payload: str | None):
+        if kind == 'device':
+            registry.invalidate(device_id)
+            versions.device_changed(device_id, local=True)
+            # Wakes up the device if it is long-polling this worker, for commands queued through another one
+            notifier.notify(device_id)
+        elif kind == 'readings':
+            versions.readings_changed(device_id, local=True)
+            if payload:
+                event = json.loads(payload)
+                events.publish(device_id, event['event'], event['data'])
+
+    async def receive(self, conn, app):
+        columns = Notification.id, Notification.origin, Notification.kind, Notification.device_id, Notification.payload
+        stmt = (
+            select(*columns)
+            .where(Notification.id > self.last_id)
+            .order_by(Notification.id)
+        )
+        rows = (await conn.execute(stmt)).all()
+        if not rows:
+            return
+
+        self.last_id = rows[-1].id
+        for row in rows:
+            if row.origin == self.origin:
+                continue
+            if row.kind == 'state':
+                await self.load_state(conn, app)
+            else:
+                self.apply(row.kind, row.device_id, row.payload)
+
+    async def send(self):
+        changes = versions.drain_outbox()
+        if not changes:
+            return
+
+        try:
+            await writer.submit(lambda session: self.publish(session, changes))
+        except Exception:
+            versions.requeue_outbox(changes)
+            raise
+
+    async def purge(self):
+        cutoff = datetime.now() - timedelta(seconds=BROKER_RETENTION_SEC)
+        stmt = delete(Notification).where(Notification.created_time < cutoff)
+        await writer.submit(lambda session: session.execute(stmt))
+
+    async def run(self, app):
+        loop = asyncio.get_running_loop()
+
+        # data_version is per connection, so the watcher keeps its own for as long as it runs
+        async with async_engine.connect() as conn:
+            self.last_id = (await conn.execute(select(func.max(Notification.id)))).scalar() or 0
+            await self.load_state(conn, app)
+            await conn.commit()
+
+            # A single worker has nobody to hear from, options it changes are already applied to its app
+            if SERVER_WORKERS == 1:
+                return
+
+            data_version = None
+            expired = purged = loop.time()
+
+            while True:
+                try:
+                    await self.send()
+
+                    current = (await conn.exec_driver_sql('PRAGMA data_version')).scalar()
+                    if current != data_version:
+                        data_version = current
+                        await self.receive(conn, app)
+
+                        # Heartbeats of devices polling other workers only show up in the database
+                        if loop.time() - expired >= PRESENCE_FLUSH_INTERVAL_SEC:
+                            expired = loop.time()
+                            versions.expire_snapshot()
+                    await conn.commit()
+
+                    if loop.time() - purged >= BROKER_RETENTION_SEC:
+                        purged = loop.time()
+                        await self.purge()
+                except Exception as e:
+                    logger.error(f'Broker failed: {e!r}')
+                    await conn.rollback()
+
+                await asyncio.sleep(BROKER_POLL_INTERVAL_SEC)
+
+    @contextmanager
+    def exclusive(self):
+        # Workers start at the same time, but only one of them may migrate the database
+        with open(f'{BROKER_LOCK_PATH}.startup', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def lead(self):
+        # Jobs that must run once per server wait here, until this worker holds the lock
+        self.lock_file = open(BROKER_LOCK_PATH, 'a')
+        while True:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logger.info(f'Broker: worker {os.getpid()} runs the background jobs')
+                return
+            except BlockingIOError:
+                await asyncio.sleep(BROKER_LEADER_RETRY_SEC)
+
+
+broker = Broker()
@@ -0,0 +1,99 @@
+from sqlalchemy import select, insert, update, delete, exists, literal, ColumnElement, String, DateTime
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from models import Device, Command
+from writer import writer
+from log import logger
+import asyncio
+import json
+
+
+COMMANDS_RETENTION_DAYS = 30
+COMMANDS_PURGE_INTERVAL_SEC = 24 * 60 * 60
+
+# Per-device command queue. Devices that fetch with batch=1 get every pending command at once and ack them
+# afterwards, older agents get one command per fetch, which counts as acked once it is handed out.
+
+
+def pending(device_id: int) -> ColumnElement:
+    return (Command.device_id == device_id) & Command.acked_time.is_(None)
+
+
+def enqueue(session: Session, targets: ColumnElement, command: str, payload: dict | None = None) -> list[int]:
+    now = datetime.now()
+    device_ids = select(Device.id).where(targets)
+
+    # A newer command of the same type replaces a pending one, so repeated requests do not pile up
+    session.execute(
+        delete(Command)
+        .where(Command.device_id.in_(device_ids))
+        .where(Command.type == command)
+        .where(Command.acked_time.is_(None))
+    )
+
+    stmt = insert(Command).from_select(
+        ['device_id', 'type', 'payload', 'created_time'],
+        select(
+            Device.id,
+            literal(command, String),
+            literal(json.dumps(payload) if payload else None, String),
+            literal(now, DateTime)
+        ).where(targets)
+    ).returning(Command.device_id)
+
+    return list(session.scalars(stmt))
+
+
+def command_response(command: Command) -> dict:
+    return {'id': command.id, 'command': command.type} | (json.loads(command.payload) if command.payload else {})
+
+
+def has_pending(session: Session, device_id: int) -> bool:
+    return session.scalar(select(exists().where(pending(device_id))))
+
+
+def pending_commands(session: Session, device_id: int) -> list[Command]:
+    return list(session.scalars(select(Command).where(pending(device_id)).order_by(Command.id)))
+
+
+def deliver_one(session: Session, device_id: int) -> tuple[dict | None, bool]:
+    command = session.scalars(select(Command).where(pending(device_id)).order_by(Command.id).limit(1)).first()
+    if not command:
+        return None, False
+
+    command.acked_time = datetime.now()
+    response = command_response(command)
+    session.flush()
+
+    return response, has_pending(session, device_id)
+
+
+def ack(session: Session, device_id: int, command_ids: list[int]) -> tuple[list[str], bool]:
+    stmt = (
+        update(Command)
+        .where(pending(device_id))
+        .where(Command.id.in_(command_ids))
+        .values(acked_time=datetime.now())
+        .returning(Command.type)
+        .execution_options(synchronize_session=False)
+    )
+    acked = list(session.scalars(stmt))
+
+    return acked, has_pending(session, device_id)
+
+
+def purge(session: Session, days: int = COMMANDS_RETENTION_DAYS) -> int:
+    cutoff = datetime.now() - timedelta(days=days)
+    return session.execute(delete(Command).where(Command.acked_time < cutoff)).rowcount
+
+
+async def run():
+    while True:
+        try:
+            count = await writer.submit(purge)
+            if count:
+                logger.info(f'Commands: purged {count} acked commands')
+        except Exception as e:
+            logger.error(f'Commands purge failed: {e!r}')
+
+        await asyncio.sleep(COMMANDS_PURGE_INTERVAL_SEC)
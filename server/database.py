@@ -1,10 +1,29 @@
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
+from contextlib import contextmanager, asynccontextmanager
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+import os
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./database.sqlite"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./database.sqlite"
+
+SQLITE_PROFILES = {
+    # Rollback journal, sqlite defaults
+    'default': {},
+    # WAL lets readers run next to the single writer, NORMAL only fsyncs on checkpoints
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'performance')
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
@@ -12,6 +31,23 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Used by the routers, so a request waiting on the database does not hold a threadpool slot.
+# Objects stay readable after commit, as lazy loading is not possible outside of the session.
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine)
+
+
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PROFILES[SQLITE_PROFILE].items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+
+event.listen(engine, 'connect', apply_sqlite_profile)
+event.listen(async_engine.sync_engine, 'connect', apply_sqlite_profile)
+
 Base = declarative_base()
 
 
@@ -22,3 +58,12 @@ def open_db_session() -> sessionmaker:
         yield db
     finally:
         db.close()
+
+
+@asynccontextmanager
+async def open_async_db_session() -> AsyncSession:
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -0,0 +1,84 @@
+from versions import versions, snapshot_statuses
+import asyncio
+import json
+
+
+EVENTS_QUEUE_SIZE = 100
+EVENTS_STATUS_INTERVAL_SEC = 5
+EVENTS_RETRY_MS = 3000
+
+# Server-sent events for the device page, one queue per open page
+
+
+def format_event(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class DeviceEvents:
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def subscribe(self, device_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        self.subscribers.setdefault(device_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, device_id: int, queue: asyncio.Queue):
+        subscribers = self.subscribers.get(device_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[device_id]
+
+    def watched(self, device_id: int) -> bool:
+        return bool(self.subscribers.get(device_id))
+
+    def publish(self, device_id: int, event: str, data: dict):
+        # Same as the notifier, publishers may run outside of the loop
+        if self.loop is not None and self.watched(device_id):
+            self.loop.call_soon_threadsafe(self._deliver, device_id, event, data)
+
+    def _deliver(self, device_id: int, event: str, data: dict):
+        for queue in self.subscribers.get(device_id, ()):
+            # A page that stopped reading loses its oldest events instead of holding up the others
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+    async def online(self, device_id: int) -> bool:
+        return snapshot_statuses(await versions.fleet_snapshot()).get(device_id, False)
+
+    async def stream(self, device_id: int):
+        queue = self.subscribe(device_id)
+        try:
+            yield f'retry: {EVENTS_RETRY_MS}\n\n'
+            online = None
+
+            while True:
+                # Devices go offline by not polling, so the status is also checked when nothing is published
+                current = await self.online(device_id)
+                if current != online:
+                    online = current
+                    yield format_event('status', {'online': online})
+
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), EVENTS_STATUS_INTERVAL_SEC)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event == 'status':
+                    if data['online'] == online:
+                        continue
+                    online = data['online']
+
+                yield format_event(event, data)
+        finally:
+            self.unsubscribe(device_id, queue)
+
+
+events = DeviceEvents()
@@ -0,0 +1,106 @@
+from typing import Iterator, Iterable
+from database import open_db_session
+from schemas import READING_FIELDS, READING_COLUMNS
+from models import Device, Reading
+from sqlalchemy import select
+from datetime import datetime
+import archive
+import orjson
+import heapq
+import zlib
+import csv
+import io
+
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_MEDIA_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Exports are generated chunk by chunk while the response is sent, so memory does not grow with the history
+
+
+def archive_rows(device_id: int, start: datetime | None, end: datetime | None) -> Iterator[tuple]:
+    # One month file in memory at a time
+    for path in archive.month_files(device_id, start, end):
+        yield from archive.column_rows(device_id, archive.filter_month(archive.load_month(path), start, end))
+
+
+def database_rows(session, device_id: int, start: datetime | None, end: datetime | None) -> Iterator[tuple]:
+    stmt = select(*READING_COLUMNS).where(Reading.device_id == device_id)
+
+    if start:
+        stmt = stmt.where(Reading.time >= start)
+    if end:
+        stmt = stmt.where(Reading.time < end)
+
+    # yield_per streams from the sqlite cursor instead of fetching the whole result
+    stmt = stmt.order_by(Reading.time, Reading.id).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    for row in session.execute(stmt):
+        yield tuple(row)
+
+
+def export_rows(device_id: int | None, start: datetime | None, end: datetime | None) -> Iterator[tuple]:
+    with open_db_session() as session:
+        if device_id is None:
+            device_ids = session.scalars(select(Device.id).order_by(Device.id)).all()
+        else:
+            device_ids = [device_id]
+
+        # Both are ordered by (time, id), but backlogged readings with old timestamps stay in the database
+        # next to archived ones, so the two are merged instead of one following the other
+        for device in device_ids:
+            yield from heapq.merge(
+                archive_rows(device, start, end), database_rows(session, device, start, end),
+                key=lambda row: (row[4], row[0])
+            )
+
+
+def format_csv(rows: list[tuple]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(
+        (id, device_id, reading, '' if value is None else value, time.isoformat(), image_hash or '')
+        for id, device_id, reading, value, time, image_hash in rows
+    )
+    return buffer.getvalue()
+
+
+def format_ndjson(rows: list[tuple]) -> str:
+    return ''.join(orjson.dumps(dict(zip(READING_FIELDS, row))).decode() + '\n' for row in rows)
+
+
+def chunked(rows: Iterable[tuple], size: int) -> Iterator[list[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_readings(
+    device_id: int | None,
+    start: datetime | None,
+    end: datetime | None,
+    format: str = 'csv',
+    compress: bool = False
+) -> Iterator[bytes]:
+    # Plain generator, starlette runs it in the threadpool so the blocking reads stay off the event loop
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    formatter = format_csv if format == 'csv' else format_ndjson
+
+    if format == 'csv':
+        header = ','.join(READING_FIELDS) + '\r\n'
+        yield compressor.compress(header.encode()) if compressor else header.encode()
+
+    for chunk in chunked(export_rows(device_id, start, end), EXPORT_CHUNK_SIZE):
+        data = formatter(chunk).encode()
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+
+    if compressor:
+        yield compressor.flush()
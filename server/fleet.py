@@ -0,0 +1,41 @@
+from sqlalchemy import update, true, ColumnElement
+from sqlalchemy.orm import Session
+from registry import registry
+from versions import versions
+from notify import notifier
+from models import Device
+import commands
+
+# Commands for many devices at once, each one a single set-based statement instead of a query per device
+
+
+def device_targets(ids: list[int] | None = None, group: str | None = None, everyone: bool = False) -> ColumnElement:
+    if everyone:
+        return true()
+    if group is not None:
+        return Device.group_name == group
+    if ids:
+        return Device.id.in_(ids)
+    raise ValueError('Expected ids, group or all')
+
+
+def update_devices(session: Session, targets: ColumnElement, **values) -> list[int]:
+    stmt = update(Device).where(targets).values(**values).returning(Device.id)
+    return list(session.scalars(stmt.execution_options(synchronize_session=False)))
+
+
+def request_readings(session: Session, targets: ColumnElement) -> list[int]:
+    return commands.enqueue(session, targets, 'get_reading')
+
+
+def set_fetch_timeouts(session: Session, targets: ColumnElement, timeout: int) -> list[int]:
+    update_devices(session, targets, fetch_timeout_sec=timeout)
+    return commands.enqueue(session, targets, 'set_settings', {'timeout': timeout})
+
+
+def devices_updated(device_ids: list[int], **fields):
+    # Has to run after the commit, same as after single device updates in the routers
+    registry.update_many(device_ids, **fields)
+    for device_id in device_ids:
+        versions.device_changed(device_id)
+        notifier.notify(device_id)
@@ -0,0 +1,197 @@
+from multipart.multipart import parse_options_header
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models import Image, Reading
+from datetime import datetime
+from sqlalchemy import update
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+import multipart
+import tempfile
+import hashlib
+import re
+import os
+
+
+IMAGES_DIR = os.environ.get('IMAGES_DIR', './images')
+IMAGE_MAX_SIZE = 16 * 1024 * 1024
+IMAGE_WRITE_BUFFER = 256 * 1024
+IMAGE_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Images are stored content-addressed as IMAGES_DIR/<first 2 hex digits>/<sha256>, so identical uploads share a file
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def image_path(digest: str) -> str:
+    return os.path.join(IMAGES_DIR, digest[:2], digest)
+
+
+def is_image_hash(value: str) -> bool:
+    return IMAGE_HASH_PATTERN.match(value) is not None
+
+
+class ImageSink:
+    # write only hashes and buffers, the file itself is written by spill, which callers run in the threadpool
+
+    def __init__(self):
+        self.file = None
+        self.buffer = bytearray()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.content_type = 'application/octet-stream'
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > IMAGE_MAX_SIZE:
+            raise ImageTooLarge(f'Image exceeds {IMAGE_MAX_SIZE} bytes')
+        self.hash.update(data)
+        self.buffer += data
+
+    def spill(self):
+        if self.file is None:
+            tmp_dir = os.path.join(IMAGES_DIR, 'tmp')
+            os.makedirs(tmp_dir, exist_ok=True)
+            self.file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+    def read(self) -> bytes:
+        self.spill()
+        self.file.flush()
+        with open(self.file.name, 'rb') as file:
+            return file.read()
+
+    def finish(self) -> str:
+        self.spill()
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = image_path(digest)
+
+        if os.path.exists(path):
+            os.unlink(self.file.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.file.name, path)
+
+        return digest
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.file is None:
+            return
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.unlink(self.file.name)
+
+
+class MultipartImageParser:
+    # Feeds the file part of a multipart body into an ImageSink, other parts are skipped
+
+    def __init__(self, boundary: bytes, sink: ImageSink):
+        self.sink = sink
+        self.header_field = b''
+        self.header_value = b''
+        self.headers: dict[bytes, bytes] = {}
+        self.in_file = False
+        self.found = False
+
+        self.parser = multipart.MultipartParser(boundary, {
+            'on_part_begin': self.on_part_begin,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+            'on_part_data': self.on_part_data,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+        self.in_file = False
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field, self.header_value = b'', b''
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b'content-disposition', b''))
+        # Only the first file part is stored
+        if b'filename' in options and not self.found:
+            self.in_file = self.found = True
+            if b'content-type' in self.headers:
+                self.sink.content_type = self.headers[b'content-type'].decode('latin-1')
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.in_file:
+            self.sink.write(data[start:end])
+
+    def write(self, data: bytes):
+        self.parser.write(data)
+
+    def finalize(self):
+        self.parser.finalize()
+
+
+async def receive_image(request: Request) -> ImageSink | None:
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    sink = ImageSink()
+
+    try:
+        if content_type == b'multipart/form-data':
+            if b'boundary' not in options:
+                raise ValueError('Missing boundary in multipart')
+            parser = MultipartImageParser(options[b'boundary'], sink)
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if len(sink.buffer) >= IMAGE_WRITE_BUFFER:
+                    await run_in_threadpool(sink.spill)
+            parser.finalize()
+
+            if not parser.found:
+                sink.abort()
+                return None
+        else:
+            sink.content_type = content_type.decode('latin-1') or sink.content_type
+            async for chunk in request.stream():
+                sink.write(chunk)
+                if len(sink.buffer) >= IMAGE_WRITE_BUFFER:
+                    await run_in_threadpool(sink.spill)
+
+            if sink.size == 0:
+                sink.abort()
+                return None
+    except BaseException:
+        sink.abort()
+        raise
+
+    return sink
+
+
+def store_image(
+    session: Session,
+    sink: ImageSink,
+    digest: str,
+    device_id: int | None = None,
+    time: datetime | None = None
+) -> int:
+    session.execute(
+        insert(Image).values(hash=digest, size=sink.size, content_type=sink.content_type, created_time=datetime.now())
+        .on_conflict_do_nothing(index_elements=['hash'])
+    )
+
+    if device_id is None or time is None:
+        return 0
+
+    result = session.execute(
+        update(Reading).where(Reading.device_id == device_id).where(Reading.time == time).values(image_hash=digest)
+    )
+    return result.rowcount
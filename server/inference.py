@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from log import logger
+import multiprocessing
+import numpy as np
+import asyncio
+import os
+
+
+# Same model and settings as the device uses in rpi/device.json, inference is disabled when no model is set
+INFERENCE_MODEL_PATH = os.environ.get('INFERENCE_MODEL_PATH')
+INFERENCE_CONF = float(os.environ.get('INFERENCE_CONF', 0.3))
+INFERENCE_IMAGE_SIZE = int(os.environ.get('INFERENCE_IMAGE_SIZE', 416))
+INFERENCE_SCALE_METHOD = os.environ.get('INFERENCE_SCALE_METHOD', 'crop')
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', os.cpu_count() or 1))
+INFERENCE_MAX_BATCH = 16
+INFERENCE_MAX_LATENCY_SEC = 0.05
+
+# Loaded once per worker process
+model = None
+
+
+def load_model():
+    global model
+    if model is None:
+        from ultralytics import YOLO
+        model = YOLO(INFERENCE_MODEL_PATH, task='detect')
+    return model
+
+
+def preprocess(frame: np.ndarray) -> np.ndarray:
+    import cv2
+
+    # Mirrors detect() in rpi/detect.py, so server readings match the ones made on the device
+    if INFERENCE_SCALE_METHOD == 'resize':
+        return cv2.resize(frame, (INFERENCE_IMAGE_SIZE, INFERENCE_IMAGE_SIZE))
+    elif INFERENCE_SCALE_METHOD == 'crop':
+        h, w, _ = frame.shape
+        x = int((w - INFERENCE_IMAGE_SIZE) / 2)
+        return frame[0:h, x:x+w]
+    return frame
+
+
+def boxes_to_reading(boxes) -> str:
+    classes = sorted(((int(box.xyxy[0][0].item()), int(box.cls)) for box in boxes), key=lambda e: e[0])
+    return reduce(lambda res, e: res + str(e[1]), classes, '')
+
+
+def decode_frame(image: bytes) -> np.ndarray | None:
+    import cv2
+
+    # None for anything that is not an image, so one broken upload cannot fail the batch it would share
+    frame = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    return frame if frame is not None and frame.size else None
+
+
+def infer_batch(frames: list[np.ndarray]) -> list[str]:
+    frames = [preprocess(frame) for frame in frames]
+    results = load_model()(frames, conf=INFERENCE_CONF, verbose=False, imgsz=INFERENCE_IMAGE_SIZE)
+    return [boxes_to_reading(result.boxes) for result in results]
+
+
+class InferenceService:
+    def __init__(self):
+        self.queue: asyncio.Queue | None = None
+        self.pool: ProcessPoolExecutor | None = None
+        self.slots: asyncio.Semaphore | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def enabled(self) -> bool:
+        return INFERENCE_MODEL_PATH is not None
+
+    async def submit(self, frame: np.ndarray) -> str:
+        if self.queue is None:
+            raise RuntimeError('Inference service is not running')
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((frame, future))
+        return await future
+
+    async def execute(self, batch: list[tuple[np.ndarray, asyncio.Future]]):
+        try:
+            readings = await asyncio.get_running_loop().run_in_executor(
+                self.pool, infer_batch, [frame for frame, _ in batch]
+            )
+        except Exception as e:
+            logger.error(f'Inference failed: {e!r}')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+
+        for (_, future), reading in zip(batch, readings):
+            if not future.done():
+                future.set_result(reading)
+
+    async def run(self):
+        if not self.enabled():
+            return
+
+        # spawn, as forking a process that runs an event loop and threads is not safe
+        self.pool = ProcessPoolExecutor(INFERENCE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(INFERENCE_WORKERS)
+        loop = asyncio.get_running_loop()
+        logger.info(f'Inference: {INFERENCE_MODEL_PATH} on {INFERENCE_WORKERS} workers')
+
+        try:
+            while True:
+                # One batch per worker process, frames keep queueing up while all of them are busy
+                await self.slots.acquire()
+
+                # Frames that arrive within the latency budget of the first one share a forward pass
+                batch = [await self.queue.get()]
+                deadline = loop.time() + INFERENCE_MAX_LATENCY_SEC
+
+                while len(batch) < INFERENCE_MAX_BATCH:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                task = asyncio.create_task(self.execute(batch))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+inference = InferenceService()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+from datetime import datetime, timedelta
+from models import READING_TIME_FORMAT
+from time import perf_counter
+import numpy as np
+import asyncio
+import random
+import httpx
+import sys
+import os
+
+
+# Virtual devices get ids from here on, so they do not collide with real ones
+LOADTEST_FIRST_ID = int(os.environ.get('LOADTEST_FIRST_ID', 1000000))
+LOADTEST_LONG_POLL = int(os.environ.get('LOADTEST_LONG_POLL', 30))
+LOADTEST_MAX_CONNECTIONS = int(os.environ.get('LOADTEST_MAX_CONNECTIONS', 1000))
+LOADTEST_SEED_INTERVAL_SEC = 15 * 60
+LOADTEST_SEED_CHUNK_SIZE = 10000
+LOADTEST_DEFAULT_DURATION_SEC = 60
+LOADTEST_DEFAULT_REQUEST_RATE = 10
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    async def call(self, endpoint: str, request) -> httpx.Response | None:
+        start = perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            response = None
+
+        self.latencies.setdefault(endpoint, []).append(perf_counter() - start)
+        if response is None or response.status_code != 200:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None
+        return response
+
+    def report(self, elapsed: float):
+        print(f'{"endpoint":<16} {"requests":>9} {"req/s":>9} {"errors":>7} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = np.array(latencies) * 1000
+            errors = self.errors.get(endpoint, 0)
+            print(
+                f'{endpoint:<16} {len(latencies):>9} {len(latencies) / elapsed:>9.1f} '
+                f'{errors / len(latencies):>7.2%} {np.percentile(latencies, 50):>9.1f} '
+                f'{np.percentile(latencies, 99):>9.1f} {latencies.max():>9.1f}'
+            )
+
+
+async def virtual_device(client: httpx.AsyncClient, stats: Stats, device_id: int, deadline: float):
+    # Same protocol as Application.run in rpi/app.py
+    params = {'id': device_id}
+    registered = False
+    fetch_delay = 5
+
+    await asyncio.sleep(random.uniform(0, fetch_delay))
+
+    while perf_counter() < deadline:
+        polled, next_poll = False, None
+
+        if not registered:
+            response = await stats.call('register', client.get('/api/rpi/register', params=params))
+            if response and response.json().get('status') == 'registered':
+                registered = True
+                response = await stats.call('get_settings', client.get('/api/rpi/get_settings', params=params))
+                if response:
+                    fetch_delay = int(response.json()['timeout'])
+        else:
+            fetch_params = params | {'batch': 1} | ({'wait': LOADTEST_LONG_POLL} if LOADTEST_LONG_POLL else {})
+            response = await stats.call('fetch', client.get('/api/rpi/fetch', params=fetch_params))
+            polled = response is not None and bool(LOADTEST_LONG_POLL)
+            payload = response.json() if response else {}
+            next_poll = payload.get('next_poll')
+
+            if payload.get('command') == 'register':
+                registered = False
+
+            for command in payload.get('commands', ()):
+                if command['command'] == 'get_reading':
+                    reading = {
+                        'reading': str(random.randint(0, 99999999)),
+                        'time': datetime.now().strftime(READING_TIME_FORMAT)
+                    }
+                    await stats.call('send_reading', client.post('/api/rpi/send_reading', params=params, json=reading))
+                elif command['command'] == 'set_settings':
+                    fetch_delay = int(command['timeout'])
+
+            if payload.get('commands'):
+                ids = [command['id'] for command in payload['commands']]
+                await stats.call('ack', client.post('/api/rpi/ack', params=params, json={'ids': ids}))
+
+        if next_poll is not None:
+            await asyncio.sleep(next_poll)
+        elif not polled:
+            await asyncio.sleep(fetch_delay)
+
+
+async def request_readings(client: httpx.AsyncClient, stats: Stats, devices: int, rate: float, deadline: float):
+    # Stands in for users and schedules asking devices for readings, which is what makes them send any
+    pending = set()
+    while perf_counter() < deadline:
+        params = {'id': LOADTEST_FIRST_ID + random.randrange(devices)}
+        request = client.get('/api/client/request_reading', params=params)
+        task = asyncio.create_task(stats.call('request_reading', request))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        await asyncio.sleep(random.expovariate(rate))
+
+    await asyncio.gather(*pending)
+
+
+async def run_load(url: str, devices: int, duration: float, rate: float):
+    stats = Stats()
+    limits = httpx.Limits(max_connections=LOADTEST_MAX_CONNECTIONS, max_keepalive_connections=LOADTEST_MAX_CONNECTIONS)
+    timeout = httpx.Timeout(LOADTEST_LONG_POLL + 30, pool=None)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        start = perf_counter()
+        deadline = start + duration
+
+        tasks = [
+            asyncio.create_task(virtual_device(client, stats, LOADTEST_FIRST_ID + i, deadline)) for i in range(devices)
+        ]
+        if rate > 0:
+            tasks.append(asyncio.create_task(request_readings(client, stats, devices, rate, deadline)))
+
+        await asyncio.gather(*tasks)
+        stats.report(perf_counter() - start)
+
+
+def seed(devices: int, readings: int):
+    from sqlalchemy.dialects.sqlite import insert
+    from database import engine, open_db_session
+    from models import Device, Reading
+    from migrations import migrate
+    from rollups import apply_readings
+    from broker import broker
+
+    migrate(engine)
+    now = datetime.now().replace(microsecond=0)
+
+    with open_db_session() as session:
+        device_ids = [LOADTEST_FIRST_ID + i for i in range(devices)]
+        session.execute(
+            insert(Device).on_conflict_do_nothing(index_elements=['id']),
+            [{'id': device_id, 'name': f'loadtest-{device_id}', 'scenario': ''} for device_id in device_ids]
+        )
+        # A running server picks the new devices up through its broker, like changes made by another worker.
+        # Only servers with SERVER_WORKERS > 1 run one, a single worker has to be restarted after seeding.
+        broker.publish(session, {('device', device_id, None) for device_id in device_ids})
+        session.commit()
+
+        for device_id in device_ids:
+            # Meter values only grow, one reading per interval going back from now
+            value = random.randint(0, 1000000)
+            for chunk_start in range(0, readings, LOADTEST_SEED_CHUNK_SIZE):
+                rows = []
+                for i in range(chunk_start, min(chunk_start + LOADTEST_SEED_CHUNK_SIZE, readings)):
+                    value += random.randint(0, 10)
+                    time = now - timedelta(seconds=LOADTEST_SEED_INTERVAL_SEC * (readings - i))
+                    rows.append({'device_id': device_id, 'reading': str(value), 'value': value, 'time': time})
+
+                stmt = insert(Reading.__table__).on_conflict_do_nothing(index_elements=['device_id', 'time'])
+                session.execute(stmt, rows)
+                apply_readings(session, device_id, [(row['time'], row['value']) for row in rows])
+            broker.publish(session, {('readings', device_id, None)})
+            session.commit()
+
+    print(f'Seeded {devices} devices with {readings} readings each')
+
+
+def clear():
+    from sqlalchemy import select, delete
+    from archive import delete_device_archive
+    from database import engine, open_db_session
+    from models import Device, Reading, Command, CaptureSchedule
+    from migrations import migrate
+    from rollups import ROLLUPS
+    from broker import broker
+
+    migrate(engine)
+
+    with open_db_session() as session:
+        device_ids = session.scalars(select(Device.id).where(Device.id >= LOADTEST_FIRST_ID)).all()
+        for device_id in device_ids:
+            delete_device_archive(device_id)
+        for model, _ in ROLLUPS:
+            session.execute(delete(model).where(model.device_id >= LOADTEST_FIRST_ID))
+        session.execute(delete(CaptureSchedule).where(CaptureSchedule.device_id >= LOADTEST_FIRST_ID))
+        session.execute(delete(Command).where(Command.device_id >= LOADTEST_FIRST_ID))
+        session.execute(delete(Reading).where(Reading.device_id >= LOADTEST_FIRST_ID))
+        session.execute(delete(Device).where(Device.id >= LOADTEST_FIRST_ID))
+        broker.publish(session, {('device', device_id, None) for device_id in device_ids})
+        session.commit()
+
+    print(f'Removed devices with id >= {LOADTEST_FIRST_ID}')
+
+
+def usage():
+    print(
+        'Usage: ./loadtest.py COMMAND [ARGS...]\n'
+        'Commands:\n'
+        '    s|seed DEVICES READINGS - Add DEVICES virtual devices with READINGS readings of history each\n'
+        '    r|run URL DEVICES [SECONDS] [RATE] - Run DEVICES virtual devices against the server at URL\n'
+        f'        for SECONDS (default {LOADTEST_DEFAULT_DURATION_SEC}), requesting RATE readings per second '
+        f'(default {LOADTEST_DEFAULT_REQUEST_RATE})\n'
+        '    c|clear - Remove virtual devices and their readings\n'
+        'A server running with SERVER_WORKERS=1 only sees seeded or cleared devices after a restart\n'
+    )
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+        exit('Error: Invalid arguments')
+
+    if sys.argv[1] in ['s', 'seed'] and len(sys.argv) == 4:
+        seed(int(sys.argv[2]), int(sys.argv[3]))
+    elif sys.argv[1] in ['r', 'run'] and len(sys.argv) >= 4:
+        duration = float(sys.argv[4]) if len(sys.argv) > 4 else LOADTEST_DEFAULT_DURATION_SEC
+        rate = float(sys.argv[5]) if len(sys.argv) > 5 else LOADTEST_DEFAULT_REQUEST_RATE
+        asyncio.run(run_load(sys.argv[2], int(sys.argv[3]), duration, rate))
+    elif sys.argv[1] in ['c', 'clear']:
+        clear()
+    else:
+        usage()
+        exit('Error: Invalid arguments')
+
+
+if __name__ == '__main__':
+    main()
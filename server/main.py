@@ -1,22 +1,58 @@
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from presence import presence
+from inference import inference
+from scheduler import scheduler
+from writer import writer
+from broker import broker, SERVER_WORKERS
+from versions import versions
+from notify import notifier
+from events import events
+from migrations import migrate
 from database import engine
 from log import logger
 import routers.client as client
 import routers.rpi as rpi
 import routers.ui as ui
 import uvicorn
-import models
+import commands
+import archive
+import asyncio
+import metrics
+
+
+async def run_jobs():
+    # Once per server, not once per worker
+    await broker.lead()
+    await asyncio.gather(archive.run(), scheduler.run(), commands.run())
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.templates = Jinja2Templates(directory="templates")
-    models.Base.metadata.create_all(bind=engine)
+    with broker.exclusive():
+        migrate(engine)
+    versions.shared = SERVER_WORKERS > 1
+    notifier.bind(asyncio.get_running_loop())
+    events.bind(asyncio.get_running_loop())
     app.prod = True
+    writer_task = asyncio.create_task(writer.run())
+    presence_task = asyncio.create_task(presence.run())
+    broker_task = asyncio.create_task(broker.run(app))
+    inference_task = asyncio.create_task(inference.run())
+    jobs_task = asyncio.create_task(run_jobs())
     yield
+    jobs_task.cancel()
+    inference_task.cancel()
+    broker_task.cancel()
+    presence_task.cancel()
+    # Tasks only stop at their next await, the writer has to outlive everything that may still submit to it
+    await asyncio.gather(jobs_task, inference_task, broker_task, presence_task, return_exceptions=True)
+    await presence.flush()
+    writer_task.cancel()
+    await asyncio.gather(writer_task, return_exceptions=True)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -25,6 +61,11 @@ app.include_router(rpi.router, prefix='/api/rpi')
 app.include_router(ui.router, prefix='/ui')
 
 
+@app.middleware('http')
+async def metrics_middleware(request: Request, call_next):
+    return await metrics.observe_request(request, call_next)
+
+
 @app.exception_handler(Exception)
 def server_exception_handler(request: Request, exc: Exception) -> JSONResponse:
     logger.error(f'Failed {request.method} at {request.url} with message: {exc!r}')
@@ -39,13 +80,19 @@ def server_exception_handler(request: Request, exc: Exception) -> JSONResponse:
 
 
 @app.get('/api/set_server_options')
-def api_set_server_options(request: Request):
+async def api_set_server_options(request: Request):
     if 'prod' in request.query_params:
         request.app.prod = request.query_params['prod'] == 'true'
+        await broker.set_state('prod', 'true' if request.app.prod else 'false')
 
     return {'message': 'ok'}
 
 
+@app.get('/metrics')
+def api_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @app.get("/")
 def root():
     return RedirectResponse(app.url_path_for('ui_home'))
@@ -56,7 +103,9 @@ if __name__ == '__main__':
         'main:app',
         host='0.0.0.0',
         port=8000,
-        reload=True,
+        # Reloading only works with a single worker
+        workers=SERVER_WORKERS,
+        reload=SERVER_WORKERS == 1,
         reload_dirs='./',
         use_colors=True,
         root_path='./',
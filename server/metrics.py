@@ -0,0 +1,168 @@
+from database import engine, async_engine
+from contextvars import ContextVar
+from fastapi import Request
+from sqlalchemy import event
+from time import perf_counter
+import threading
+import bisect
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Prometheus text exposition, kept in process so no client library is needed
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        METRICS.append(self)
+
+    def header(self) -> list[str]:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f'{self.name}{format_labels(self.labels, labels)} {value}' for labels, value in sorted(values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            # Per bucket counts, made cumulative on render, plus sum and count
+            counts, total, count = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0, 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.values.items()}
+
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {count}')
+        return lines
+
+
+METRICS: list[Metric] = []
+
+http_requests = Counter('http_requests_total', 'HTTP requests by route and status', ('route', 'method', 'status'))
+http_exceptions = Counter('http_exceptions_total', 'Requests that raised an unhandled exception', ('route', 'exception'))
+http_in_flight = Gauge('http_requests_in_flight', 'HTTP requests currently being handled')
+http_latency = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency, long-polls included', ('route',), LATENCY_BUCKETS
+)
+http_queries = Histogram(
+    'http_request_db_queries', 'Database queries issued by a request', ('route',), QUERY_COUNT_BUCKETS
+)
+http_query_time = Counter('http_request_db_duration_seconds_total', 'Time requests spent in queries', ('route',))
+db_query_latency = Histogram('db_query_duration_seconds', 'Query latency by statement', ('operation',), QUERY_BUCKETS)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+# Set per request, queries the writer runs for it are counted on the writer's side only
+request_stats: ContextVar[RequestStats | None] = ContextVar('request_stats', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - context.metrics_start
+    operation = (statement.split(None, 1) or ['UNKNOWN'])[0].upper()
+    db_query_latency.observe(elapsed, operation)
+
+    stats = request_stats.get()
+    if stats:
+        stats.queries += 1
+        stats.query_time += elapsed
+
+
+for sync_engine in (engine, async_engine.sync_engine):
+    event.listen(sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def route_name(request: Request) -> str:
+    # Endpoint names instead of raw paths, so ids in the path do not blow up the label set
+    route = request.scope.get('route')
+    return getattr(route, 'name', None) or 'unmatched'
+
+
+async def observe_request(request: Request, call_next):
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    http_in_flight.inc()
+    start = perf_counter()
+    status = 500
+
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    except Exception as e:
+        http_exceptions.inc(route_name(request), type(e).__name__)
+        raise
+    finally:
+        route = route_name(request)
+        http_in_flight.dec()
+        http_requests.inc(route, request.method, str(status))
+        http_latency.observe(perf_counter() - start, route)
+        http_queries.observe(stats.queries, route)
+        http_query_time.inc(route, amount=stats.query_time)
+        request_stats.reset(token)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+from sqlalchemy import Engine, Connection, inspect
+from models import Base, parse_reading_time, parse_reading_value
+from sqlalchemy.orm import Session
+from datetime import datetime
+from log import logger
+
+# Schema version is kept in sqlite's PRAGMA user_version, step N upgrades version N-1 to N
+
+# How SQLAlchemy stores DateTime columns in sqlite
+SQLITE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def table_columns(conn: Connection, table: str) -> list[str]:
+    return [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')]
+
+
+def migrate_readings_time_series(conn: Connection):
+    if 'value' in table_columns(conn, 'readings'):
+        return
+
+    rows = conn.exec_driver_sql('SELECT id, device_id, reading, time FROM readings').all()
+
+    conn.exec_driver_sql(
+        'CREATE TABLE readings_new ('
+        'id INTEGER NOT NULL, '
+        'device_id INTEGER, '
+        'reading VARCHAR, '
+        'value INTEGER, '
+        'time DATETIME, '
+        'PRIMARY KEY (id), '
+        'FOREIGN KEY(device_id) REFERENCES devices (id))'
+    )
+
+    if rows:
+        conn.exec_driver_sql(
+            'INSERT INTO readings_new (id, device_id, reading, value, time) VALUES (?, ?, ?, ?, ?)',
+            [
+                (id, device_id, reading,
+                 parse_reading_value(reading),
+                 parse_reading_time(time).strftime(SQLITE_DATETIME_FORMAT) if time else None)
+                for id, device_id, reading, time in rows
+            ]
+        )
+
+    conn.exec_driver_sql('DROP TABLE readings')
+    conn.exec_driver_sql('ALTER TABLE readings_new RENAME TO readings')
+    conn.exec_driver_sql('CREATE INDEX ix_readings_device_id_time ON readings (device_id, time)')
+
+
+def migrate_rollups(conn: Connection):
+    from rollups import ROLLUPS, backfill
+
+    for model, _ in ROLLUPS:
+        model.__table__.create(conn, checkfirst=True)
+
+    with Session(bind=conn) as session:
+        backfill(session)
+
+
+def migrate_readings_unique_time(conn: Connection):
+    from rollups import backfill
+
+    conn.exec_driver_sql(
+        'DELETE FROM readings WHERE id NOT IN (SELECT MIN(id) FROM readings GROUP BY device_id, time)'
+    )
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_readings_device_id_time')
+    conn.exec_driver_sql('CREATE UNIQUE INDEX ix_readings_device_id_time ON readings (device_id, time)')
+
+    # Duplicates were counted into the rollups as well
+    with Session(bind=conn) as session:
+        backfill(session)
+
+
+def migrate_readings_autoincrement(conn: Connection):
+    from archive import max_archived_id
+
+    conn.exec_driver_sql(
+        'CREATE TABLE readings_new ('
+        'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+        'device_id INTEGER, '
+        'reading VARCHAR, '
+        'value INTEGER, '
+        'time DATETIME, '
+        'FOREIGN KEY(device_id) REFERENCES devices (id))'
+    )
+    conn.exec_driver_sql(
+        'INSERT INTO readings_new (id, device_id, reading, value, time) '
+        'SELECT id, device_id, reading, value, time FROM readings'
+    )
+    conn.exec_driver_sql('DROP TABLE readings')
+    conn.exec_driver_sql('ALTER TABLE readings_new RENAME TO readings')
+    conn.exec_driver_sql('CREATE UNIQUE INDEX ix_readings_device_id_time ON readings (device_id, time)')
+
+    # Readings archived before this migration may have had their ids reused already, at least stop it from now on
+    conn.exec_driver_sql(
+        "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'readings'", (max_archived_id(),)
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'readings', ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'readings')", (max_archived_id(),)
+    )
+
+
+def migrate_reading_images(conn: Connection):
+    from models import Image
+
+    Image.__table__.create(conn, checkfirst=True)
+    if 'image_hash' not in table_columns(conn, 'readings'):
+        conn.exec_driver_sql('ALTER TABLE readings ADD COLUMN image_hash VARCHAR REFERENCES images (hash)')
+
+
+def migrate_fleet_scheduling(conn: Connection):
+    from models import CaptureSchedule
+
+    if 'group_name' not in table_columns(conn, 'devices'):
+        conn.exec_driver_sql('ALTER TABLE devices ADD COLUMN group_name VARCHAR')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_devices_group_name ON devices (group_name)')
+    CaptureSchedule.__table__.create(conn, checkfirst=True)
+
+
+def migrate_command_queue(conn: Connection):
+    from models import Command
+
+    Command.__table__.create(conn, checkfirst=True)
+
+    # Pending flags become queued commands, capture requests first, as the flags were delivered in that order
+    now = datetime.now().strftime(SQLITE_DATETIME_FORMAT)
+    conn.exec_driver_sql(
+        "INSERT INTO commands (device_id, type, payload, created_time) "
+        "SELECT id, 'get_reading', NULL, ? FROM devices WHERE capture_request",
+        (now,)
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO commands (device_id, type, payload, created_time) "
+        "SELECT id, 'set_settings', json_object('timeout', fetch_timeout_sec), ? FROM devices WHERE set_settings",
+        (now,)
+    )
+
+    conn.exec_driver_sql(
+        'CREATE TABLE devices_new ('
+        'id INTEGER NOT NULL, '
+        'name VARCHAR, '
+        'scenario VARCHAR, '
+        'group_name VARCHAR, '
+        'fetch_timeout_sec INTEGER, '
+        'online_timeout_sec INTEGER, '
+        'last_online_time DATETIME, '
+        'PRIMARY KEY (id))'
+    )
+    conn.exec_driver_sql(
+        'INSERT INTO devices_new '
+        '(id, name, scenario, group_name, fetch_timeout_sec, online_timeout_sec, last_online_time) '
+        'SELECT id, name, scenario, group_name, fetch_timeout_sec, online_timeout_sec, last_online_time FROM devices'
+    )
+    conn.exec_driver_sql('DROP TABLE devices')
+    conn.exec_driver_sql('ALTER TABLE devices_new RENAME TO devices')
+    conn.exec_driver_sql('CREATE INDEX ix_devices_group_name ON devices (group_name)')
+
+
+def migrate_broker(conn: Connection):
+    from models import Notification, ServerState
+
+    Notification.__table__.create(conn, checkfirst=True)
+    ServerState.__table__.create(conn, checkfirst=True)
+
+
+def migrate_notification_payload(conn: Connection):
+    if 'payload' not in table_columns(conn, 'notifications'):
+        conn.exec_driver_sql('ALTER TABLE notifications ADD COLUMN payload VARCHAR')
+
+
+MIGRATIONS = [
+    migrate_readings_time_series,
+    migrate_rollups,
+    migrate_readings_unique_time,
+    migrate_readings_autoincrement,
+    migrate_reading_images,
+    migrate_fleet_scheduling,
+    migrate_command_queue,
+    migrate_broker,
+    migrate_notification_payload,
+]
+
+
+def migrate(engine: Engine):
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+        if not inspect(conn).has_table('devices'):
+            # Fresh database, create_all already produces the latest schema
+            version = len(MIGRATIONS)
+
+        for step, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f'Migrate database to version {step}: {migration.__name__}')
+            migration(conn)
+
+        Base.metadata.create_all(bind=conn)
+        conn.exec_driver_sql(f'PRAGMA user_version = {len(MIGRATIONS)}')
+
+
+if __name__ == '__main__':
+    from database import engine
+    migrate(engine)
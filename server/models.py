@@ -1,13 +1,15 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index
 from datetime import datetime, timedelta
-from sqlalchemy.orm import relationship
-from sqlalchemy import select
+from sqlalchemy.orm import relationship, declared_attr
 from database import Base
 
 
 FETCH_DEFAULT_TIMEOUT = 10
 ONLINE_DEFAULT_TIMEOUT = 120
 
+# Format of timestamps sent by devices
+READING_TIME_FORMAT = '%d-%m-%Y_%H-%M-%S'
+
 
 class Device(Base):
     __tablename__ = 'devices'
@@ -17,33 +19,119 @@ class Device(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     scenario = Column(String)
+    group_name = Column(String, index=True)  # Devices in a group can be commanded together
     # Timing
     fetch_timeout_sec = Column(Integer, default=FETCH_DEFAULT_TIMEOUT)
     online_timeout_sec = Column(Integer, default=ONLINE_DEFAULT_TIMEOUT)
     last_online_time = Column(DateTime, default=datetime.now() - timedelta(hours=1))
-    # Behaviour flags
-    set_settings = Column(Boolean, default=False)
-    capture_request = Column(Boolean, default=False)
 
     readings = relationship("Reading", cascade="all,delete", backref="parent")
 
-    def is_online(self) -> bool:
-        from database import open_db_session
-        with open_db_session() as session:
-            stmt = select(Device).where(Device.id == self.id)
-            device = session.scalars(stmt).one_or_none()
-            if not device:
-                return False
-            seconds = device.online_timeout_sec
-
-        return datetime.now() - self.last_online_time <= timedelta(seconds=seconds)
-
 
 class Reading(Base):
     __tablename__ = "readings"
+    __table_args__ = (
+        Index('ix_readings_device_id_time', 'device_id', 'time', unique=True),
+        # Ids of archived (deleted) rows must never be handed out again
+        {'extend_existing': True, 'sqlite_autoincrement': True}
+    )
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"))
+    reading = Column(String)  # Raw digits as recognized by the device
+    value = Column(Integer)
+    time = Column(DateTime)
+    image_hash = Column(String, ForeignKey("images.hash"))
+
+
+class Image(Base):
+    __tablename__ = "images"
     __table_args__ = {'extend_existing': True}
 
+    hash = Column(String, primary_key=True)  # sha256 of the content, also its path in the image store
+    size = Column(Integer)
+    content_type = Column(String)
+    created_time = Column(DateTime, default=datetime.now)
+
+
+class Command(Base):
+    __tablename__ = 'commands'
+    __table_args__ = (
+        Index('ix_commands_device_id_acked_time', 'device_id', 'acked_time'),
+        {'extend_existing': True}
+    )
+
     id = Column(Integer, primary_key=True)
     device_id = Column(Integer, ForeignKey("devices.id"))
-    reading = Column(String)
-    time = Column(String)  # Format %d-%m-%Y_%H-%M-%S
+    type = Column(String)  # get_reading, set_settings, ...
+    payload = Column(String)  # JSON object merged into the command sent to the device
+    created_time = Column(DateTime, default=datetime.now)
+    acked_time = Column(DateTime)  # NULL while pending
+
+
+class Notification(Base):
+    # Changes made by one server worker, picked up by the others
+    __tablename__ = 'notifications'
+    __table_args__ = {'extend_existing': True, 'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(String)  # Worker that made the change
+    kind = Column(String)  # device, readings or state
+    device_id = Column(Integer)
+    payload = Column(String)  # Live event the other workers pass on to their subscribers, as JSON
+    created_time = Column(DateTime, default=datetime.now)
+
+
+class ServerState(Base):
+    # Server options shared by all workers
+    __tablename__ = 'server_state'
+    __table_args__ = {'extend_existing': True}
+
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+class CaptureSchedule(Base):
+    __tablename__ = 'capture_schedules'
+    __table_args__ = {'extend_existing': True}
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"), index=True)
+    interval_sec = Column(Integer)
+    jitter_sec = Column(Integer, default=0)
+    next_time = Column(DateTime)  # Without jitter, so the schedule does not drift
+
+
+class RollupMixin:
+    __table_args__ = {'extend_existing': True}
+
+    @declared_attr
+    def device_id(cls):
+        return Column(Integer, ForeignKey("devices.id"), primary_key=True)
+
+    period_start = Column(DateTime, primary_key=True)
+    first_time = Column(DateTime)
+    first_value = Column(Integer)
+    last_time = Column(DateTime)
+    last_value = Column(Integer)
+    delta = Column(Integer)
+    count = Column(Integer)
+
+
+class HourlyRollup(RollupMixin, Base):
+    __tablename__ = 'readings_hourly'
+
+
+class DailyRollup(RollupMixin, Base):
+    __tablename__ = 'readings_daily'
+
+
+def parse_reading_time(time: str) -> datetime:
+    try:
+        return datetime.strptime(time, READING_TIME_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(time)
+
+
+def parse_reading_value(reading: str) -> int | None:
+    return int(reading) if reading and reading.isdigit() else None
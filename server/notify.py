@@ -0,0 +1,41 @@
+import asyncio
+
+
+class DeviceNotifier:
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.waiters: dict[int, set[asyncio.Event]] = {}
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def subscribe(self, device_id: int) -> asyncio.Event:
+        event = asyncio.Event()
+        self.waiters.setdefault(device_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, device_id: int, event: asyncio.Event):
+        waiters = self.waiters.get(device_id)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self.waiters[device_id]
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def notify(self, device_id: int):
+        # Handlers may run in the threadpool, so wake-ups are always marshalled onto the loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wake, device_id)
+
+    def _wake(self, device_id: int):
+        for event in self.waiters.get(device_id, ()):
+            event.set()
+
+
+notifier = DeviceNotifier()
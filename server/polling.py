@@ -0,0 +1,38 @@
+from registry import DeviceEntry
+from events import events
+import random
+import os
+
+
+POLL_ACTIVE_SEC = float(os.environ.get('POLL_ACTIVE_SEC', 1))
+POLL_MAX_SEC = float(os.environ.get('POLL_MAX_SEC', 300))
+POLL_ONLINE_MARGIN = 0.5
+
+# Hint for how long a device should wait before its next fetch. Devices someone is looking at, or that have
+# commands waiting, poll quickly, idle ones back off exponentially from their fetch timeout.
+
+
+class PollCadence:
+    def __init__(self):
+        self.idle: dict[int, int] = {}
+
+    def next_poll(self, device_id: int, entry: DeviceEntry, idle: bool, waited: float = 0) -> float:
+        if not idle or entry.has_pending() or events.watched(device_id):
+            self.idle.pop(device_id, None)
+            # A long-poll already waits on the server, so the device can come back right away
+            return 0 if waited else POLL_ACTIVE_SEC
+
+        streak = self.idle[device_id] = self.idle.get(device_id, 0) + 1
+
+        # Has to stay well below the online timeout, or backed off devices would show up as offline
+        limit = min(POLL_MAX_SEC, entry.online_timeout_sec * POLL_ONLINE_MARGIN)
+        backoff = min(entry.fetch_timeout_sec * 2 ** min(streak - 1, 16), limit)
+
+        # Jitter keeps devices that went idle together from polling in step
+        return round(max(0.0, random.uniform(backoff / 2, backoff) - waited), 1)
+
+    def forget(self, device_id: int):
+        self.idle.pop(device_id, None)
+
+
+cadence = PollCadence()
@@ -0,0 +1,76 @@
+from sqlalchemy import update, bindparam
+from datetime import datetime
+from models import Device
+from writer import writer
+from log import logger
+import threading
+import asyncio
+
+
+PRESENCE_FLUSH_INTERVAL_SEC = 5
+
+
+class PresenceTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_seen: dict[int, datetime] = {}
+        self.dirty: dict[int, datetime] = {}
+
+    def heartbeat(self, device_id: int):
+        now = datetime.now()
+        with self.lock:
+            self.last_seen[device_id] = now
+            self.dirty[device_id] = now
+
+    def get(self, device_id: int) -> datetime | None:
+        return self.last_seen.get(device_id)
+
+    def latest(self, device_id: int, stored: datetime) -> datetime:
+        # With several workers a device may poll another one, which only shares heartbeats through the database
+        seen = self.last_seen.get(device_id)
+        return max(seen, stored) if seen and stored else seen or stored
+
+    def forget(self, device_id: int):
+        with self.lock:
+            self.last_seen.pop(device_id, None)
+            self.dirty.pop(device_id, None)
+
+    async def flush(self) -> int:
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+
+        if not dirty:
+            return 0
+
+        table = Device.__table__
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam('device_id'))
+            .values(last_online_time=bindparam('time'))
+        )
+
+        params = [{'device_id': k, 'time': v} for k, v in dirty.items()]
+
+        try:
+            await writer.submit(lambda session: session.execute(stmt, params))
+        except Exception:
+            # Keep the batch for the next flush, unless a newer heartbeat already replaced it
+            with self.lock:
+                for device_id, time in dirty.items():
+                    self.dirty.setdefault(device_id, time)
+            raise
+
+        return len(dirty)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL_SEC)
+            try:
+                count = await self.flush()
+                if count:
+                    logger.debug(f'Presence: flushed {count} heartbeats')
+            except Exception as e:
+                logger.error(f'Presence flush failed: {e!r}')
+
+
+presence = PresenceTracker()
@@ -0,0 +1,137 @@
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import select, tuple_
+from rollups import apply_readings
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from datetime import datetime
+from models import Reading, parse_reading_value
+from schemas import ReadingSchema, READING_COLUMNS, reading_schema
+import archive
+import base64
+
+
+READINGS_DEFAULT_LIMIT = 100
+READINGS_MAX_LIMIT = 1000
+READINGS_BATCH_MAX = 1000
+
+
+def encode_cursor(time: datetime, reading_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{time.isoformat()}|{reading_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    time, reading_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(time), int(reading_id)
+
+
+def insert_readings(session: Session, device_id: int, readings: list[tuple[datetime, str]]) -> int:
+    # Readings are unique per (device_id, time), the first one in a batch wins
+    batch = {}
+    for time, reading in readings:
+        batch.setdefault(time, reading)
+
+    existing = set(session.scalars(
+        select(Reading.time).where(Reading.device_id == device_id).where(Reading.time.in_(batch.keys()))
+    ))
+    # Already archived readings are duplicates too, they would be counted into the rollups a second time
+    existing |= archive.archived_times(device_id, batch.keys() - existing)
+
+    rows = [
+        {'device_id': device_id, 'reading': reading, 'value': parse_reading_value(reading), 'time': time}
+        for time, reading in batch.items() if time not in existing
+    ]
+
+    if not rows:
+        return 0
+
+    stmt = insert(Reading.__table__).on_conflict_do_nothing(index_elements=['device_id', 'time'])
+    session.execute(stmt, rows)
+    apply_readings(session, device_id, [(row['time'], row['value']) for row in rows])
+
+    return len(rows)
+
+
+def query_readings(
+    session: Session,
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    limit: int = READINGS_DEFAULT_LIMIT,
+    after: tuple[datetime, int] | None = None
+) -> list[ReadingSchema]:
+    # Every predicate is on (device_id, time[, rowid]), so this is a range scan over ix_readings_device_id_time
+    stmt = select(*READING_COLUMNS).where(Reading.device_id == device_id)
+
+    if start:
+        stmt = stmt.where(Reading.time >= start)
+    if end:
+        stmt = stmt.where(Reading.time < end)
+    if after:
+        stmt = stmt.where(tuple_(Reading.time, Reading.id) > tuple_(*after))
+
+    stmt = stmt.order_by(Reading.time, Reading.id).limit(limit)
+
+    return [reading_schema(row) for row in session.execute(stmt)]
+
+
+def query_values(
+    session: Session,
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None
+) -> list[tuple[datetime, int]]:
+    stmt = (
+        select(Reading.time, Reading.value)
+        .where(Reading.device_id == device_id)
+        .where(Reading.value.is_not(None))
+    )
+
+    if start:
+        stmt = stmt.where(Reading.time >= start)
+    if end:
+        stmt = stmt.where(Reading.time < end)
+
+    return [tuple(row) for row in session.execute(stmt.order_by(Reading.time)).all()]
+
+
+def readings_page(readings: list[ReadingSchema], limit: int) -> dict:
+    next_cursor = None
+    if len(readings) == limit:
+        next_cursor = encode_cursor(readings[-1]['time'], readings[-1]['id'])
+
+    return {'readings': readings, 'next_cursor': next_cursor}
+
+
+# Hot rows live in sqlite, cold ones in the archive files. These merge both, so callers see a single history.
+
+async def history_readings(
+    session: AsyncSession,
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    limit: int = READINGS_DEFAULT_LIMIT,
+    after: tuple[datetime, int] | None = None
+) -> list[ReadingSchema]:
+    hot = await session.run_sync(query_readings, device_id, start, end, limit, after)
+    cold = await run_in_threadpool(archive.query_readings, device_id, start, end, limit, after)
+
+    if not cold:
+        return hot
+
+    return sorted(cold + hot, key=lambda reading: (reading['time'], reading['id']))[:limit]
+
+
+async def history_values(
+    session: AsyncSession,
+    device_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None
+) -> list[tuple[datetime, int]]:
+    hot = await session.run_sync(query_values, device_id, start, end)
+    cold = await run_in_threadpool(archive.query_values, device_id, start, end)
+
+    if not cold:
+        return hot
+
+    return sorted(cold + hot, key=lambda row: row[0])
@@ -0,0 +1,100 @@
+from database import open_async_db_session
+from dataclasses import dataclass, replace
+from collections import OrderedDict
+from commands import has_pending
+from models import Device
+from sqlalchemy import select
+import threading
+
+
+REGISTRY_UNKNOWN_MAX = 1024
+
+
+@dataclass
+class DeviceEntry:
+    fetch_timeout_sec: int
+    online_timeout_sec: int
+    pending: bool
+
+    @classmethod
+    def from_device(cls, device: Device, pending: bool) -> 'DeviceEntry':
+        return cls(
+            fetch_timeout_sec=device.fetch_timeout_sec,
+            online_timeout_sec=device.online_timeout_sec,
+            pending=pending
+        )
+
+    def has_pending(self) -> bool:
+        return self.pending
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: dict[int, DeviceEntry] = {}
+        # Unregistered ids are remembered too, so their polls do not hit the database either. Only the most
+        # recent ones though, a client walking through ids must not grow the cache without limit.
+        self.unknown: OrderedDict[int, None] = OrderedDict()
+        self.generation = 0
+
+    def remember_unknown(self, device_id: int):
+        self.unknown[device_id] = None
+        self.unknown.move_to_end(device_id)
+        while len(self.unknown) > REGISTRY_UNKNOWN_MAX:
+            self.unknown.popitem(last=False)
+
+    async def get(self, device_id: int) -> DeviceEntry | None:
+        with self.lock:
+            if device_id in self.entries:
+                return self.entries[device_id]
+            if device_id in self.unknown:
+                self.unknown.move_to_end(device_id)
+                return None
+            generation = self.generation
+
+        async with open_async_db_session() as session:
+            stmt = select(Device).where(Device.id == device_id).limit(1)
+            device = (await session.scalars(stmt)).one_or_none()
+            entry = DeviceEntry.from_device(device, await session.run_sync(has_pending, device_id)) if device else None
+
+        with self.lock:
+            # Do not cache a row that was changed by a writer while it was being loaded
+            if generation == self.generation:
+                if entry:
+                    self.entries[device_id] = entry
+                else:
+                    self.remember_unknown(device_id)
+
+        return entry
+
+    def update(self, device: Device):
+        with self.lock:
+            current = self.entries.get(device.id)
+            self.unknown.pop(device.id, None)
+            # Pending state is only known for cached entries, others are loaded again on the next get
+            if current is not None:
+                self.entries[device.id] = DeviceEntry.from_device(device, current.pending)
+            self.generation += 1
+
+    def update_many(self, device_ids: list[int], **fields):
+        # After set-based updates, entries that are not cached yet are loaded with the new values anyway
+        with self.lock:
+            for device_id in device_ids:
+                if device_id in self.entries:
+                    self.entries[device_id] = replace(self.entries[device_id], **fields)
+            self.generation += 1
+
+    def remove(self, device_id: int):
+        with self.lock:
+            self.entries.pop(device_id, None)
+            self.remember_unknown(device_id)
+            self.generation += 1
+
+    def invalidate(self, device_id: int):
+        with self.lock:
+            self.entries.pop(device_id, None)
+            self.unknown.pop(device_id, None)
+            self.generation += 1
+
+
+registry = DeviceRegistry()
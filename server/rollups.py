@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import select, delete, case
+from sqlalchemy.orm import Session
+from datetime import datetime
+from models import *
+import sys
+
+
+BACKFILL_CHUNK_SIZE = 10000
+
+
+def hour_start(time: datetime) -> datetime:
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(time: datetime) -> datetime:
+    return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+ROLLUPS = (
+    (HourlyRollup, hour_start),
+    (DailyRollup, day_start),
+)
+
+
+def aggregate(device_id: int, values: list[tuple[datetime, int]], period) -> list[dict]:
+    buckets = {}
+
+    for time, value in values:
+        start = period(time)
+        bucket = buckets.get(start)
+        if bucket is None:
+            buckets[start] = {
+                'device_id': device_id, 'period_start': start,
+                'first_time': time, 'first_value': value,
+                'last_time': time, 'last_value': value,
+                'delta': 0, 'count': 1
+            }
+            continue
+
+        if time < bucket['first_time']:
+            bucket['first_time'], bucket['first_value'] = time, value
+        if time >= bucket['last_time']:
+            bucket['last_time'], bucket['last_value'] = time, value
+        bucket['delta'] = bucket['last_value'] - bucket['first_value']
+        bucket['count'] += 1
+
+    return list(buckets.values())
+
+
+def upsert_statement(model):
+    stmt = insert(model)
+    new = stmt.excluded
+
+    # SET expressions in sqlite upsert all see the old row, so delta is derived from the same CASEs
+    first_earlier = new.first_time < model.first_time
+    last_later = new.last_time >= model.last_time
+    first_value = case((first_earlier, new.first_value), else_=model.first_value)
+    last_value = case((last_later, new.last_value), else_=model.last_value)
+
+    return stmt.on_conflict_do_update(
+        index_elements=['device_id', 'period_start'],
+        set_={
+            'first_time': case((first_earlier, new.first_time), else_=model.first_time),
+            'first_value': first_value,
+            'last_time': case((last_later, new.last_time), else_=model.last_time),
+            'last_value': last_value,
+            'delta': last_value - first_value,
+            'count': model.count + new.count,
+        }
+    )
+
+
+def apply_readings(session: Session, device_id: int, values: list[tuple[datetime, int | None]]):
+    values = [(time, value) for time, value in values if value is not None]
+    if not values:
+        return
+
+    for model, period in ROLLUPS:
+        session.execute(upsert_statement(model), aggregate(device_id, values, period))
+
+
+def delete_device_rollups(session: Session, device_id: int):
+    for model, _ in ROLLUPS:
+        session.execute(delete(model).where(model.device_id == device_id))
+
+
+def query_rollups(
+    session: Session,
+    device_id: int,
+    period: str,
+    start: datetime | None = None,
+    end: datetime | None = None
+) -> list[dict]:
+    model = DailyRollup if period in ('day', 'month') else HourlyRollup
+
+    stmt = select(model).where(model.device_id == device_id)
+    if start:
+        stmt = stmt.where(model.period_start >= start)
+    if end:
+        stmt = stmt.where(model.period_start < end)
+
+    # Stored delta only covers a bucket's own readings. Consumption is counted from the last value of the bucket
+    # before, so whatever the meter advanced between two buckets is not lost and the deltas add up to the total.
+    previous = None
+    if start:
+        previous = session.scalar(
+            select(model.last_value)
+            .where(model.device_id == device_id)
+            .where(model.period_start < start)
+            .order_by(model.period_start.desc())
+            .limit(1)
+        )
+
+    rows = []
+    for row in session.scalars(stmt.order_by(model.period_start)):
+        rows.append({
+            'period_start': row.period_start,
+            'first_time': row.first_time, 'first_value': row.first_value,
+            'last_time': row.last_time, 'last_value': row.last_value,
+            'delta': row.last_value - (row.first_value if previous is None else previous), 'count': row.count
+        })
+        previous = row.last_value
+
+    if period != 'month':
+        return rows
+
+    # Months are folded from at most 31 daily rows each
+    months = {}
+    for row in rows:
+        start = row['period_start'].replace(day=1)
+        month = months.get(start)
+        if month is None:
+            months[start] = row | {'period_start': start}
+            continue
+        month['last_time'], month['last_value'] = row['last_time'], row['last_value']
+        month['delta'] += row['delta']
+        month['count'] += row['count']
+
+    return list(months.values())
+
+
+def backfill(session: Session):
+    import archive
+
+    for model, _ in ROLLUPS:
+        session.execute(delete(model))
+
+    for device_id in session.scalars(select(Device.id)).all():
+        # Archived readings are gone from the readings table, but their periods keep their rollups
+        values = archive.query_values(device_id)
+        for chunk_start in range(0, len(values), BACKFILL_CHUNK_SIZE):
+            apply_readings(session, device_id, values[chunk_start:chunk_start + BACKFILL_CHUNK_SIZE])
+
+        stmt = (
+            select(Reading.time, Reading.value)
+            .where(Reading.device_id == device_id)
+            .where(Reading.value.is_not(None))
+            .order_by(Reading.time)
+            .execution_options(yield_per=BACKFILL_CHUNK_SIZE)
+        )
+
+        for chunk in session.execute(stmt).partitions():
+            apply_readings(session, device_id, [tuple(row) for row in chunk])
+
+
+def usage():
+    print(
+        'Usage: ./rollups.py COMMAND\n'
+        'Commands:\n'
+        '    b|backfill - Rebuild hourly/daily rollups from readings and the archive\n'
+    )
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+        exit('Error: Invalid arguments')
+
+    if sys.argv[1] in ['b', 'backfill']:
+        from database import open_db_session
+        with open_db_session() as session:
+            backfill(session)
+            session.commit()
+    else:
+        usage()
+        exit('Error: Invalid arguments')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,128 +1,413 @@
-from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse, FileResponse, Response, StreamingResponse
 from fastapi import APIRouter, Request
-from database import open_db_session
-from sqlalchemy import select
+from database import open_async_db_session
+from presence import presence
+from registry import registry
+from events import events
+from versions import versions, response_cache, snapshot_statuses
+from readings import *
+from series import *
+from archive import delete_device_archive
+from export import export_readings, EXPORT_FORMATS, EXPORT_MEDIA_TYPES
+from images import *
+from schemas import DEVICE_COLUMNS, SCHEDULE_COLUMNS, device_schema, device_status_schema, schedule_schema
+from scheduler import scheduler
+from polling import cadence
+import fleet
+from rollups import query_rollups, delete_device_rollups
+from sqlalchemy import select, delete
 from models import *
+import os
 
 router = APIRouter()
 
 
+def parse_time_param(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value else None
+
+
+def parse_device_targets(request: Request):
+    ids = [int(i) for i in request.query_params['ids'].split(',') if i] if 'ids' in request.query_params else None
+    everyone = request.query_params.get('all') in ('1', 'true')
+    return fleet.device_targets(ids, request.query_params.get('group'), everyone)
+
+
 @router.get('/get_readings')
-def client_get_reading(request: Request):
-    with open_db_session() as session:
-        stmt = select(Reading)
-        for attr, value in request.query_params.items():
-            stmt = stmt.filter(getattr(Reading, attr).like("%%%s%%" % value))
-        return {'readings': session.scalars(stmt).all()}
+async def client_get_reading(request: Request):
+    if 'device_id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected device_id in url params'}, 400)
+
+    try:
+        device_id = int(request.query_params['device_id'])
+        start = parse_time_param(request.query_params.get('from'))
+        end = parse_time_param(request.query_params.get('to'))
+        limit = max(min(int(request.query_params.get('limit', READINGS_DEFAULT_LIMIT)), READINGS_MAX_LIMIT), 1)
+        after = decode_cursor(request.query_params['cursor']) if 'cursor' in request.query_params else None
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    async with open_async_db_session() as session:
+        readings = await history_readings(session, device_id, start, end, limit, after)
+        return ORJSONResponse(readings_page(readings, limit))
+
+
+@router.get('/readings_series')
+async def client_readings_series(request: Request):
+    if 'device_id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected device_id in url params'}, 400)
+
+    method = request.query_params.get('method', 'lttb')
+    if method not in SERIES_METHODS:
+        return JSONResponse({'status': 'error', 'message': f'Expected method to be one of {SERIES_METHODS}'}, 400)
+
+    try:
+        device_id = int(request.query_params['device_id'])
+        start = parse_time_param(request.query_params.get('from'))
+        end = parse_time_param(request.query_params.get('to'))
+        points = max(min(int(request.query_params.get('points', SERIES_DEFAULT_POINTS)), SERIES_MAX_POINTS), 1)
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    async with open_async_db_session() as session:
+        rows = await history_values(session, device_id, start, end)
+
+    return ORJSONResponse({'device_id': device_id} | downsample(rows, points, method))
+
+
+@router.get('/get_consumption')
+async def client_get_consumption(request: Request):
+    if 'device_id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected device_id in url params'}, 400)
+
+    period = request.query_params.get('period', 'day')
+    if period not in ('hour', 'day', 'month'):
+        return JSONResponse({'status': 'error', 'message': 'Expected period to be one of hour, day, month'}, 400)
+
+    try:
+        device_id = int(request.query_params['device_id'])
+        start = parse_time_param(request.query_params.get('from'))
+        end = parse_time_param(request.query_params.get('to'))
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    async with open_async_db_session() as session:
+        return ORJSONResponse({
+            'device_id': device_id,
+            'period': period,
+            'consumption': await session.run_sync(query_rollups, device_id, period, start, end)
+        })
+
+
+@router.get('/export_readings')
+async def client_export_readings(request: Request):
+    export_format = request.query_params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JSONResponse({'status': 'error', 'message': f'Expected format to be one of {EXPORT_FORMATS}'}, 400)
+
+    try:
+        device_id = int(request.query_params['device_id']) if 'device_id' in request.query_params else None
+        start = parse_time_param(request.query_params.get('from'))
+        end = parse_time_param(request.query_params.get('to'))
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    compress = request.query_params.get('gzip') in ('1', 'true')
+
+    # Without device_id the whole fleet is exported, device by device
+    filename = f'readings{"" if device_id is None else f"-{device_id}"}.{export_format}{".gz" if compress else ""}'
+
+    return StreamingResponse(
+        export_readings(device_id, start, end, export_format, compress),
+        media_type='application/gzip' if compress else EXPORT_MEDIA_TYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@router.get('/events')
+async def client_events(request: Request):
+    if 'id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
+
+    return StreamingResponse(
+        events.stream(int(request.query_params['id'])),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@router.get('/image/{digest}')
+async def client_get_image(request: Request, digest: str):
+    if not is_image_hash(digest):
+        return JSONResponse({'status': 'error', 'message': 'no such image'}, 404)
+
+    # Content never changes for a given hash, so it is the ETag and can be cached forever
+    headers = {'ETag': f'"{digest}"', 'Cache-Control': IMAGE_CACHE_CONTROL}
+
+    if request.headers.get('if-none-match') in (f'"{digest}"', f'W/"{digest}"', '*'):
+        return Response(status_code=304, headers=headers)
+
+    async with open_async_db_session() as session:
+        image = await session.get(Image, digest)
+
+    if not image or not os.path.exists(image_path(digest)):
+        return JSONResponse({'status': 'error', 'message': 'no such image'}, 404)
+
+    return FileResponse(image_path(digest), media_type=image.content_type, headers=headers)
 
 
 @router.get('/add_device')
-def client_add_device(request: Request):
+async def client_add_device(request: Request):
     if 'id' not in request.query_params or 'name' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id and name'}, 400)
 
-    with open_db_session() as session:
+    async with open_async_db_session() as session:
         device = Device(
             id=int(request.query_params['id']),
             name=request.query_params['name'],
-            scenario=''
+            scenario='',
+            group_name=request.query_params.get('group') or None
         )
 
         session.add(device)
-        session.commit()
+        await session.commit()
+        registry.update(device)
+        versions.device_changed(device.id)
 
     return {'status': 'ok'}
 
 
 @router.get('/get_device')
-def client_get_device(request: Request):
+async def client_get_device(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
-        stmt = select(Device).where(Device.id == int(request.query_params['id']))
-        device = session.scalars(stmt).one_or_none()
+    async with open_async_db_session() as session:
+        stmt = select(*DEVICE_COLUMNS).where(Device.id == int(request.query_params['id']))
+        row = (await session.execute(stmt)).one_or_none()
 
-    return device if device else JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
+    if not row:
+        return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
+
+    return ORJSONResponse(device_schema(row))
 
 
 @router.get('/del_device')
-def client_del_device(request: Request):
+async def client_del_device(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
+    async with open_async_db_session() as session:
         stmt = select(Device).where(Device.id == int(request.query_params['id']))
-        device = session.scalars(stmt).one_or_none()
+        device = (await session.scalars(stmt)).one_or_none()
 
         if device:
-            session.delete(device)
-            session.commit()
+            # Bulk deletes instead of ORM cascade, which would have to load every reading first
+            await session.run_sync(delete_device_rollups, device.id)
+            await session.execute(delete(CaptureSchedule).where(CaptureSchedule.device_id == device.id))
+            await session.execute(delete(Command).where(Command.device_id == device.id))
+            await session.execute(delete(Reading).where(Reading.device_id == device.id))
+            await session.execute(delete(Device).where(Device.id == device.id))
+            await session.commit()
+            await run_in_threadpool(delete_device_archive, device.id)
+            presence.forget(device.id)
+            registry.remove(device.id)
+            scheduler.remove_device(device.id)
+            cadence.forget(device.id)
+            versions.device_changed(device.id)
 
     return {'status': 'ok'} if device else JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
 
 
 @router.get('/get_devices')
-def client_get_devices(request: Request):
-    with open_db_session() as session:
-        stmt = select(Device)
-        return session.scalars(stmt).all()
+async def client_get_devices(request: Request):
+    with_status = request.query_params.get('with_status') in ('1', 'true')
+
+    # Heartbeats alone do not change the tag, the last online time it returns is only as fresh as online status
+    snapshot = await versions.fleet_snapshot()
+    etag = versions.etag('devices', versions.fleet, with_status, sorted(snapshot_statuses(snapshot).items()))
+
+    if cached := response_cache.lookup(request, etag):
+        return cached
+
+    async with open_async_db_session() as session:
+        rows = (await session.execute(select(*DEVICE_COLUMNS))).all()
+
+    if with_status:
+        now = datetime.now()
+        content = [device_status_schema(row, now) for row in rows]
+    else:
+        content = [device_schema(row) for row in rows]
+
+    return response_cache.store(etag, ORJSONResponse(content))
 
 
 @router.get('/request_reading')
-def client_request_reading(request: Request):
+async def client_request_reading(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
-        stmt = select(Device).where(Device.id == int(request.query_params['id']))
-        device = session.scalars(stmt).one_or_none()
+    async with open_async_db_session() as session:
+        device_ids = await session.run_sync(fleet.request_readings, Device.id == int(request.query_params['id']))
+        await session.commit()
 
-        if device:
-            device.capture_request = True
-            session.add(device)
-            session.commit()
+    if not device_ids:
+        return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
 
-            return {'status': 'ok'}
+    fleet.devices_updated(device_ids, pending=True)
 
-    return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
+    return {'status': 'ok'}
 
 
 @router.get('/set_fetch_timeout')
-def client_set_fetch_timeout(request: Request):
+async def client_set_fetch_timeout(request: Request):
+    if 'id' not in request.query_params or 'value' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
+
+    timeout = int(request.query_params['value'])
+
+    async with open_async_db_session() as session:
+        targets = Device.id == int(request.query_params['id'])
+        device_ids = await session.run_sync(fleet.set_fetch_timeouts, targets, timeout)
+        await session.commit()
+
+    if not device_ids:
+        return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
+
+    fleet.devices_updated(device_ids, fetch_timeout_sec=timeout, pending=True)
+
+    return {'status': 'ok'}
+
+
+@router.get('/set_online_timeout')
+async def client_set_online_timeout(request: Request):
     if 'id' not in request.query_params or 'value' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
+    async with open_async_db_session() as session:
         stmt = select(Device).where(Device.id == int(request.query_params['id']))
-        device = session.scalars(stmt).one_or_none()
+        device = (await session.scalars(stmt)).one_or_none()
 
         if device:
-            device.fetch_timeout_sec = int(request.query_params['value'])
-            device.set_settings = True
+            device.online_timeout_sec = int(request.query_params['value'])
             session.add(device)
-            session.commit()
+            await session.commit()
+            registry.update(device)
+            versions.device_changed(device.id)
 
             return {'status': 'ok'}
 
     return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
 
 
-@router.get('/set_online_timeout')
-def client_set_online_timeout(request: Request):
-    if 'id' not in request.query_params or 'value' not in request.query_params:
+@router.get('/set_group')
+async def client_set_group(request: Request):
+    if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
+    async with open_async_db_session() as session:
         stmt = select(Device).where(Device.id == int(request.query_params['id']))
-        device = session.scalars(stmt).one_or_none()
+        device = (await session.scalars(stmt)).one_or_none()
 
         if device:
-            device.online_timeout_sec = int(request.query_params['value'])
-            device.set_settings = True
+            device.group_name = request.query_params.get('group') or None
             session.add(device)
-            session.commit()
+            await session.commit()
+            versions.device_changed(device.id)
 
             return {'status': 'ok'}
 
-    return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
\ No newline at end of file
+    return JSONResponse({'status': 'error', 'message': 'no such device'}, 404)
+
+
+@router.get('/bulk_request_reading')
+async def client_bulk_request_reading(request: Request):
+    try:
+        targets = parse_device_targets(request)
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    async with open_async_db_session() as session:
+        device_ids = await session.run_sync(fleet.request_readings, targets)
+        await session.commit()
+
+    fleet.devices_updated(device_ids, pending=True)
+
+    return {'status': 'ok', 'devices': len(device_ids)}
+
+
+@router.get('/bulk_set_fetch_timeout')
+async def client_bulk_set_fetch_timeout(request: Request):
+    try:
+        targets = parse_device_targets(request)
+        timeout = int(request.query_params['value'])
+    except (ValueError, KeyError) as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e!r}'}, 400)
+
+    async with open_async_db_session() as session:
+        device_ids = await session.run_sync(fleet.set_fetch_timeouts, targets, timeout)
+        await session.commit()
+
+    fleet.devices_updated(device_ids, fetch_timeout_sec=timeout, pending=True)
+
+    return {'status': 'ok', 'devices': len(device_ids)}
+
+
+@router.get('/add_schedule')
+async def client_add_schedule(request: Request):
+    try:
+        targets = parse_device_targets(request)
+        interval = int(request.query_params['interval'])
+        jitter = int(request.query_params.get('jitter', 0))
+        start = parse_time_param(request.query_params.get('start')) or datetime.now()
+    except (ValueError, KeyError) as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e!r}'}, 400)
+
+    if interval <= 0 or jitter < 0:
+        return JSONResponse({'status': 'error', 'message': 'Expected positive interval and jitter'}, 400)
+
+    # One schedule per device, the jitter spreads their triggers
+    async with open_async_db_session() as session:
+        device_ids = (await session.scalars(select(Device.id).where(targets))).all()
+        schedules = [
+            CaptureSchedule(device_id=device_id, interval_sec=interval, jitter_sec=jitter, next_time=start)
+            for device_id in device_ids
+        ]
+        session.add_all(schedules)
+        await session.commit()
+
+    for schedule in schedules:
+        scheduler.add(schedule)
+
+    return {'status': 'ok', 'schedules': [schedule.id for schedule in schedules]}
+
+
+@router.get('/get_schedules')
+async def client_get_schedules(request: Request):
+    stmt = select(*SCHEDULE_COLUMNS).order_by(CaptureSchedule.id)
+    if 'device_id' in request.query_params:
+        stmt = stmt.where(CaptureSchedule.device_id == int(request.query_params['device_id']))
+
+    async with open_async_db_session() as session:
+        rows = (await session.execute(stmt)).all()
+
+    return ORJSONResponse([schedule_schema(row) for row in rows])
+
+
+@router.get('/del_schedule')
+async def client_del_schedule(request: Request):
+    if 'id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
+
+    schedule_id = int(request.query_params['id'])
+
+    async with open_async_db_session() as session:
+        result = await session.execute(delete(CaptureSchedule).where(CaptureSchedule.id == schedule_id))
+        await session.commit()
+
+    scheduler.remove(schedule_id)
+
+    if not result.rowcount:
+        return JSONResponse({'status': 'error', 'message': 'no such schedule'}, 404)
+
+    return {'status': 'ok'}
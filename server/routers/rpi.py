@@ -1,109 +1,304 @@
+from starlette.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from fastapi import APIRouter, Request
 from pydantic import BaseModel
-from sqlalchemy import select
-from database import open_db_session
+from database import open_async_db_session
+from registry import registry, DeviceEntry
+from presence import presence
+from notify import notifier
+from versions import versions
+from events import events
+from polling import cadence
+from writer import writer
+import commands
+from images import receive_image, store_image, ImageTooLarge
+from readings import insert_readings, READINGS_BATCH_MAX
+from inference import inference, decode_frame
 from models import *
 from log import logger
+from time import perf_counter
 
 router = APIRouter()
 
+LONG_POLL_MAX_WAIT = 60
+
 
 class ReadingModel(BaseModel):
     reading: str
     time: str
 
 
-def get_settings_response(device: Device) -> dict:
+class AckModel(BaseModel):
+    ids: list[int]
+
+
+def get_settings_response(device: Device | DeviceEntry) -> dict:
     return {
         'command': 'set_settings',
         'timeout': device.fetch_timeout_sec
     }
 
 
+def reading_event(time: datetime, reading: str) -> dict:
+    return {'reading': reading, 'value': parse_reading_value(reading), 'time': time.isoformat(timespec='seconds')}
+
+
+def readings_inserted(device_id: int, event: str, data: dict):
+    # Other workers pass the same event on to their own subscribers
+    versions.readings_changed(device_id, event=(event, data))
+    events.publish(device_id, event, data)
+
+
+async def fetch_command(device_id: int, batch: bool = False) -> dict:
+    entry = await registry.get(device_id)
+
+    if not entry:
+        return {'command': 'register'}
+
+    previous = presence.get(device_id)
+    presence.heartbeat(device_id)
+    if previous is None or datetime.now() - previous > timedelta(seconds=entry.online_timeout_sec):
+        events.publish(device_id, 'status', {'online': True})
+
+    if not entry.has_pending():
+        return {'command': 'idle'}
+
+    if batch:
+        # Handed out until the device acks them, so a command is not lost if the device fails halfway
+        async with open_async_db_session() as session:
+            pending = await session.run_sync(commands.pending_commands, device_id)
+
+        if not pending:
+            registry.invalidate(device_id)
+            return {'command': 'idle'}
+
+        return {'command': 'batch', 'commands': [commands.command_response(command) for command in pending]}
+
+    response, remaining = await writer.submit(lambda session: commands.deliver_one(session, device_id))
+
+    if not remaining:
+        # Reloaded from the database instead of cleared, a command queued meanwhile must not be missed
+        registry.invalidate(device_id)
+
+    if not response:
+        return {'command': 'idle'}
+
+    events.publish(device_id, 'command', {'command': response['command']})
+    return response
+
+
 @router.get('/fetch')
-def rpi_fetch(request: Request):
+async def rpi_fetch(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
-        stmt = select(Device).where(Device.id == int(request.query_params['id'])).limit(1)
-        device = session.scalars(stmt).one_or_none()
+    device_id = int(request.query_params['id'])
+    wait = min(float(request.query_params.get('wait', 0)), LONG_POLL_MAX_WAIT)
+    batch = request.query_params.get('batch') in ('1', 'true')
 
-        if not device:
-            return {'command': 'register'}
+    # Time the request was actually parked on the notifier, which is 0 unless it had nothing to hand out
+    waited = 0
 
-        device.last_online_time = datetime.now()
-        session.add(device)
-        session.commit()
+    if wait <= 0:
+        response = await fetch_command(device_id, batch)
+    else:
+        # Subscribe before the first check, so a command queued in between is not missed
+        event = notifier.subscribe(device_id)
+        try:
+            response = await fetch_command(device_id, batch)
+            if response['command'] == 'idle':
+                if not event.is_set():
+                    start = perf_counter()
+                    await notifier.wait(event, wait)
+                    waited = perf_counter() - start
+                if event.is_set():
+                    response = await fetch_command(device_id, batch)
+        finally:
+            notifier.unsubscribe(device_id, event)
 
-        if device.capture_request:
-            device.capture_request = False
-            session.add(device)
-            session.commit()
-            return {'command': 'get_reading'}
+    entry = await registry.get(device_id)
+    if entry:
+        idle = response['command'] == 'idle'
+        response['next_poll'] = cadence.next_poll(device_id, entry, idle, waited)
 
-        if device.set_settings:
-            device.set_settings = False
-            session.add(device)
-            session.commit()
-            return get_settings_response(device)
+    return response
+
+
+@router.post('/ack')
+async def rpi_ack(request: Request, payload: AckModel):
+    if 'id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    return {'command': 'idle'}
+    device_id = int(request.query_params['id'])
+
+    acked, remaining = await writer.submit(lambda session: commands.ack(session, device_id, payload.ids))
+
+    if not remaining:
+        registry.invalidate(device_id)
+
+    for command in acked:
+        events.publish(device_id, 'command', {'command': command})
+
+    return {'status': 'ok', 'acked': len(acked)}
 
 
 @router.get('/get_settings')
-def rpi_get_settings(request: Request):
+async def rpi_get_settings(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
-        stmt = select(Device).where(Device.id == int(request.query_params['id'])).limit(1)
-        device = session.scalars(stmt).one_or_none()
+    entry = await registry.get(int(request.query_params['id']))
 
-        if not device:
-            return {'command': 'register'}
+    if not entry:
+        return {'command': 'register'}
 
-        return get_settings_response(device)
+    return get_settings_response(entry)
 
 
 @router.get('/register')
-def rpi_register(request: Request):
+async def rpi_register(request: Request):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
-    with open_db_session() as session:
-        stmt = select(Device).where(Device.id == int(request.query_params['id'])).limit(1)
-        device = session.scalars(stmt).one_or_none()
-
-        if device:
-            return {'status': 'registered'}
+    if await registry.get(int(request.query_params['id'])):
+        return {'status': 'registered'}
 
     return {'status': 'unregistered'}
 
 
 @router.post('/send_reading')
-def rpi_send_reading(request: Request, payload: ReadingModel):
+async def rpi_send_reading(request: Request, payload: ReadingModel):
     if 'id' not in request.query_params:
         return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
 
     logger.info(f'Reading: {payload}')
 
-    with open_db_session() as session:
-        reading = Reading(
-            device_id=int(request.query_params['id']),
-            reading=payload.reading,
-            time=payload.time,
-        )
+    try:
+        time = parse_reading_time(payload.time)
+    except ValueError:
+        return JSONResponse({'status': 'error', 'message': f'Invalid time: {payload.time}'}, 400)
+
+    device_id = int(request.query_params['id'])
+
+    inserted = await writer.submit(lambda session: insert_readings(session, device_id, [(time, payload.reading)]))
+    if inserted:
+        readings_inserted(device_id, 'reading', reading_event(time, payload.reading))
 
-        print(f'{reading.device_id} {reading.reading} {reading.time}')
-        session.add(reading)
-        session.commit()
+    print(f'{device_id} {payload.reading} {time}{"" if inserted else " (duplicate)"}')
 
     return {'status': 'ok'}
 
 
+@router.post('/send_readings')
+async def rpi_send_readings(request: Request, payload: list[ReadingModel]):
+    if 'id' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id in url params'}, 400)
+
+    if len(payload) > READINGS_BATCH_MAX:
+        return JSONResponse({'status': 'error', 'message': f'Expected at most {READINGS_BATCH_MAX} readings'}, 400)
+
+    device_id = int(request.query_params['id'])
+
+    # A reading with a broken time is skipped, rejecting the batch would keep the device resending all of it
+    readings, invalid = [], []
+    for reading in payload:
+        try:
+            readings.append((parse_reading_time(reading.time), reading.reading))
+        except ValueError:
+            invalid.append(reading.time)
+
+    if invalid:
+        logger.warning(f'Readings: device {device_id} sent {len(invalid)} readings with invalid time: {invalid[:5]}')
+
+    inserted = await writer.submit(lambda session: insert_readings(session, device_id, readings)) if readings else 0
+    if inserted:
+        readings_inserted(device_id, 'readings', {'inserted': inserted})
+
+    logger.info(f'Readings: device {device_id} sent {len(payload)}, {inserted} new')
+
+    return {'status': 'ok', 'inserted': inserted, 'duplicates': len(readings) - inserted, 'invalid': len(invalid)}
+
+
 @router.post('/send_image')
-def rpi_send_image(request: Request):
-    logger.info('TODO: Image')
-    return {'status': 'ok'}
+@router.post('/send_detect_image')
+async def rpi_send_image(request: Request):
+    try:
+        device_id = int(request.query_params['id']) if 'id' in request.query_params else None
+        time = parse_reading_time(request.query_params['time']) if 'time' in request.query_params else None
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    try:
+        sink = await receive_image(request)
+    except ImageTooLarge as e:
+        return JSONResponse({'status': 'error', 'message': str(e)}, 413)
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid image upload: {e}'}, 400)
+
+    if not sink:
+        return JSONResponse({'status': 'error', 'message': 'Expected image'}, 400)
+
+    digest = await run_in_threadpool(sink.finish)
+    linked = await writer.submit(lambda session: store_image(session, sink, digest, device_id, time))
+    if linked:
+        versions.readings_changed(device_id)
+
+    logger.info(f'Image: {digest} ({sink.size} bytes) device {device_id} linked to {linked} readings')
+
+    return {'status': 'ok', 'hash': digest}
+
+
+@router.post('/send_frame')
+async def rpi_send_frame(request: Request):
+    if not inference.enabled():
+        return JSONResponse({'status': 'error', 'message': 'Server-side inference is not enabled'}, 503)
+
+    if 'id' not in request.query_params or 'time' not in request.query_params:
+        return JSONResponse({'status': 'error', 'message': 'Expected id and time in url params'}, 400)
+
+    try:
+        device_id = int(request.query_params['id'])
+        time = parse_reading_time(request.query_params['time'])
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid url params: {e}'}, 400)
+
+    try:
+        sink = await receive_image(request)
+    except ImageTooLarge as e:
+        return JSONResponse({'status': 'error', 'message': str(e)}, 413)
+    except ValueError as e:
+        return JSONResponse({'status': 'error', 'message': f'Invalid image upload: {e}'}, 400)
+
+    if not sink:
+        return JSONResponse({'status': 'error', 'message': 'Expected image'}, 400)
+
+    # Frames that cannot be read never reach a batch shared with other devices, nor the image store
+    frame = await run_in_threadpool(lambda: decode_frame(sink.read()))
+    if frame is None:
+        await run_in_threadpool(sink.abort)
+        return JSONResponse({'status': 'error', 'message': 'Frame is not a decodable image'}, 400)
+
+    try:
+        reading = await inference.submit(frame)
+    except Exception as e:
+        await run_in_threadpool(sink.abort)
+        return JSONResponse({'status': 'error', 'message': f'Inference failed: {e}'}, 500)
+
+    # The frame is kept as the reading's image
+    digest = await run_in_threadpool(sink.finish)
+
+    def store(session):
+        inserted = insert_readings(session, device_id, [(time, reading)])
+        store_image(session, sink, digest, device_id, time)
+        return inserted
+
+    inserted = await writer.submit(store)
+    if inserted:
+        readings_inserted(device_id, 'reading', reading_event(time, reading))
+    else:
+        # Only the image got linked to the reading that was already there
+        versions.readings_changed(device_id)
+
+    logger.info(f'Frame: device {device_id} {reading} {time}{"" if inserted else " (duplicate)"}')
+
+    return {'status': 'ok', 'reading': reading, 'hash': digest}
@@ -1,49 +1,73 @@
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from fastapi import APIRouter, Request
-from database import open_db_session
+from database import open_async_db_session
+from versions import versions, response_cache, snapshot_statuses
+from sqlalchemy import select
 from models import *
 
 router = APIRouter()
 
+DEVICE_PAGE_READINGS = 50
+
 
 @router.get('/home', response_class=HTMLResponse, name='ui_home')
-def ui_home(request: Request) -> Jinja2Templates.TemplateResponse:
-    with open_db_session() as session:
+async def ui_home(request: Request) -> Jinja2Templates.TemplateResponse:
+    statuses = snapshot_statuses(await versions.fleet_snapshot())
+    etag = versions.etag('home', versions.fleet, sorted(statuses.items()), request.app.prod)
+
+    if cached := response_cache.lookup(request, etag):
+        return cached
+
+    async with open_async_db_session() as session:
         stmt = select(Device)
+        devices = (await session.scalars(stmt)).all()
 
-        return request.app.templates.TemplateResponse(
+        return response_cache.store(etag, request.app.templates.TemplateResponse(
             request=request, name='home.html', context={
-                'devices': session.scalars(stmt).all(), 'prod': request.app.prod
+                'devices': devices, 'statuses': statuses, 'prod': request.app.prod
             }
-        )
+        ))
 
 
 @router.get('/device/{device_id}', response_class=HTMLResponse, name='ui_device')
-def ui_device(request: Request, device_id: int) -> Jinja2Templates.TemplateResponse:
-    with open_db_session() as session:
+async def ui_device(request: Request, device_id: int) -> Jinja2Templates.TemplateResponse:
+    statuses = snapshot_statuses(await versions.fleet_snapshot())
+    etag = versions.etag('device', device_id, versions.device(device_id), statuses.get(device_id), request.app.prod)
+
+    if cached := response_cache.lookup(request, etag):
+        return cached
+
+    async with open_async_db_session() as session:
         device_stmt = select(Device).where(Device.id == device_id)
-        device = session.scalars(device_stmt).one_or_none()
+        device = (await session.scalars(device_stmt)).one_or_none()
 
-        readings_stmt = select(Reading).where(Reading.device_id == device_id)
-        readings = sorted(session.scalars(readings_stmt).all(), key=lambda r: r.time)
+        # Only the latest readings are listed, the chart loads its (downsampled) series asynchronously
+        readings_stmt = (
+            select(Reading)
+            .where(Reading.device_id == device_id)
+            .order_by(Reading.time.desc())
+            .limit(DEVICE_PAGE_READINGS)
+        )
+        readings = (await session.scalars(readings_stmt)).all()[::-1]
 
         if device:
-            return request.app.templates.TemplateResponse(
+            return response_cache.store(etag, request.app.templates.TemplateResponse(
                 request=request, name='device.html', context={
-                    'device': device, 'readings': readings, 'prod': request.app.prod
+                    'device': device, 'online': statuses.get(device_id, False), 'readings': readings,
+                    'prod': request.app.prod
                 }
-            )
+            ))
 
-        return request.app.templates.TemplateResponse(
+        return response_cache.store(etag, request.app.templates.TemplateResponse(
             request=request, name='device_not_found.html', context={
                 'device_id': device_id, 'prod': request.app.prod
             }
-        )
+        ))
 
 
 @router.get('/add_device', response_class=HTMLResponse, name='ui_add_device')
-def ui_add_device(request: Request) -> Jinja2Templates.TemplateResponse:
+async def ui_add_device(request: Request) -> Jinja2Templates.TemplateResponse:
     return request.app.templates.TemplateResponse(
         request=request, name='add_device.html', context={
             'prod': request.app.prod
@@ -0,0 +1,151 @@
+from sqlalchemy import select, update, bindparam
+from database import open_async_db_session
+from datetime import datetime, timedelta
+from models import Device, CaptureSchedule
+from writer import writer
+from log import logger
+import fleet
+import asyncio
+import random
+import math
+
+
+SCHEDULER_TICK_SEC = 1
+SCHEDULER_WHEEL_SLOTS = 3600
+SCHEDULER_SYNC_INTERVAL_SEC = 10
+
+# Recurring capture requests. Every trigger is delayed by a random part of the schedule's jitter,
+# so a fleet scheduled for the same moment is asked for readings spread over the jitter window.
+
+
+class TimingWheel:
+    # Hashed timing wheel: one slot per tick, entries further away than a full turn wait out the extra rounds
+
+    def __init__(self, slots: int = SCHEDULER_WHEEL_SLOTS, tick: float = SCHEDULER_TICK_SEC):
+        self.slots: list[list[list]] = [[] for _ in range(slots)]
+        self.tick = tick
+        self.cursor = 0
+
+    def add(self, item, delay: float):
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.cursor + ticks) % len(self.slots)
+        self.slots[slot].append([(ticks - 1) // len(self.slots), item])
+
+    def advance(self) -> list:
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        due, waiting = [], []
+
+        for entry in self.slots[self.cursor]:
+            if entry[0] == 0:
+                due.append(entry[1])
+            else:
+                entry[0] -= 1
+                waiting.append(entry)
+
+        self.slots[self.cursor] = waiting
+        return due
+
+
+class CaptureScheduler:
+    def __init__(self):
+        self.wheel = TimingWheel()
+        # schedule id -> (device_id, interval_sec, jitter_sec, next_time)
+        self.schedules: dict[int, tuple[int, int, int, datetime]] = {}
+
+    def arm(self, schedule_id: int):
+        _, _, jitter_sec, next_time = self.schedules[schedule_id]
+        delay = (next_time - datetime.now()).total_seconds() + random.uniform(0, jitter_sec)
+        # next_time goes along, so an entry left over from an older version of the schedule is ignored
+        self.wheel.add((schedule_id, next_time), delay)
+
+    def add(self, schedule: CaptureSchedule):
+        self.schedules[schedule.id] = (
+            schedule.device_id, schedule.interval_sec, schedule.jitter_sec, schedule.next_time
+        )
+        self.arm(schedule.id)
+
+    def remove(self, schedule_id: int):
+        self.schedules.pop(schedule_id, None)
+
+    def remove_device(self, device_id: int):
+        for schedule_id in [k for k, v in self.schedules.items() if v[0] == device_id]:
+            self.remove(schedule_id)
+
+    async def load(self) -> int:
+        async with open_async_db_session() as session:
+            schedules = (await session.scalars(select(CaptureSchedule))).all()
+
+        # Also picks up schedules added or deleted through other workers, known ones keep their place in the wheel
+        for schedule_id in self.schedules.keys() - {schedule.id for schedule in schedules}:
+            self.remove(schedule_id)
+
+        # Schedules missed while the server was down fire once, within their jitter from now
+        added = [schedule for schedule in schedules if schedule.id not in self.schedules]
+        for schedule in added:
+            self.add(schedule)
+
+        return len(added)
+
+    async def fire(self, items: list[tuple[int, datetime]]):
+        now = datetime.now()
+        device_ids, next_times = set(), []
+
+        for schedule_id, next_time in items:
+            if schedule_id not in self.schedules or self.schedules[schedule_id][3] != next_time:
+                continue
+
+            device_id, interval_sec, jitter_sec, _ = self.schedules[schedule_id]
+            device_ids.add(device_id)
+
+            # Keeps to the original grid, intervals that were missed entirely are skipped
+            interval = timedelta(seconds=interval_sec)
+            next_time += interval * max(1, math.ceil((now - next_time) / interval))
+            self.schedules[schedule_id] = (device_id, interval_sec, jitter_sec, next_time)
+            next_times.append({'schedule_id': schedule_id, 'next_time': next_time})
+
+        if not device_ids:
+            return
+
+        table = CaptureSchedule.__table__
+        stmt = update(table).where(table.c.id == bindparam('schedule_id')).values(next_time=bindparam('next_time'))
+
+        def trigger(session):
+            updated = fleet.request_readings(session, Device.id.in_(device_ids))
+            session.execute(stmt, next_times)
+            return updated
+
+        try:
+            updated = await writer.submit(trigger)
+            fleet.devices_updated(updated, pending=True)
+        except Exception as e:
+            logger.error(f'Scheduler: failed to trigger {len(device_ids)} devices: {e!r}')
+
+        for item in next_times:
+            if item['schedule_id'] in self.schedules:
+                self.arm(item['schedule_id'])
+
+    async def run(self):
+        count = await self.load()
+        logger.info(f'Scheduler: loaded {count} capture schedules')
+
+        loop = asyncio.get_running_loop()
+        next_tick = next_sync = loop.time()
+
+        while True:
+            # Ticks are counted against the loop clock, so time spent firing does not make the wheel lag
+            next_tick += self.wheel.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+            due = self.wheel.advance()
+            if due:
+                await self.fire(due)
+
+            if loop.time() - next_sync >= SCHEDULER_SYNC_INTERVAL_SEC:
+                next_sync = loop.time()
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error(f'Scheduler: failed to sync schedules: {e!r}')
+
+
+scheduler = CaptureScheduler()
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from models import Device, Reading, CaptureSchedule
+from presence import presence
+from typing import TypedDict
+
+# Shapes of the JSON responses. Rows are selected as column projections and turned into plain dicts,
+# which orjson serializes as is, instead of ORM entities reflected by jsonable_encoder
+
+
+class DeviceSchema(TypedDict):
+    id: int
+    name: str
+    scenario: str
+    group_name: str | None
+    fetch_timeout_sec: int
+    online_timeout_sec: int
+    last_online_time: datetime
+
+
+class DeviceStatusSchema(DeviceSchema):
+    online: bool
+
+
+class ReadingSchema(TypedDict):
+    id: int
+    device_id: int
+    reading: str
+    value: int | None
+    time: datetime
+    image_hash: str | None
+
+
+class ScheduleSchema(TypedDict):
+    id: int
+    device_id: int
+    interval_sec: int
+    jitter_sec: int
+    next_time: datetime
+
+
+DEVICE_FIELDS = tuple(DeviceSchema.__annotations__)
+DEVICE_COLUMNS = tuple(getattr(Device, field) for field in DEVICE_FIELDS)
+
+READING_FIELDS = tuple(ReadingSchema.__annotations__)
+READING_COLUMNS = tuple(getattr(Reading, field) for field in READING_FIELDS)
+
+SCHEDULE_FIELDS = tuple(ScheduleSchema.__annotations__)
+SCHEDULE_COLUMNS = tuple(getattr(CaptureSchedule, field) for field in SCHEDULE_FIELDS)
+
+
+def device_schema(row: tuple) -> DeviceSchema:
+    device = dict(zip(DEVICE_FIELDS, row))
+    # Heartbeats are reported as they come in, not only once presence flushed them to the row
+    device['last_online_time'] = presence.latest(device['id'], device['last_online_time'])
+    return device
+
+
+def device_status_schema(row: tuple, now: datetime) -> DeviceStatusSchema:
+    device = device_schema(row)
+    device['online'] = now - device['last_online_time'] <= timedelta(seconds=device['online_timeout_sec'])
+    return device
+
+
+def reading_schema(row: tuple) -> ReadingSchema:
+    return dict(zip(READING_FIELDS, row))
+
+
+def schedule_schema(row: tuple) -> ScheduleSchema:
+    return dict(zip(SCHEDULE_FIELDS, row))
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import numpy as np
+
+
+SERIES_DEFAULT_POINTS = 500
+SERIES_MAX_POINTS = 5000
+SERIES_METHODS = ('lttb', 'avg', 'minmax')
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+
+
+def to_arrays(rows: list[tuple[datetime, int]]) -> tuple[np.ndarray, np.ndarray]:
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    # Much faster than letting numpy convert datetime objects to datetime64 itself
+    x = np.fromiter(((time - EPOCH) // SECOND for time, _ in rows), dtype=np.int64, count=len(rows))
+    y = np.fromiter((value for _, value in rows), dtype=np.float64, count=len(rows))
+    return x, y
+
+
+# Largest-Triangle-Three-Buckets, returns indices of the points to keep
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    size = len(x)
+    if points >= size:
+        return np.arange(size)
+    if points < 3:
+        # Too few for buckets between the ends, keep the first point and then the last one
+        return np.array([0, size - 1][:points], dtype=np.int64)
+
+    # First and last points are always kept, the rest is split into points - 2 buckets
+    edges = np.linspace(1, size - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (size - 1, size)
+
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
+
+
+# Splits sorted timestamps into equal time windows, returns index of the first point of every non-empty window
+def bucket_starts(x: np.ndarray, points: int) -> np.ndarray:
+    width = max((x[-1] - x[0]) / points, 1)
+    buckets = np.minimum(((x - x[0]) / width).astype(np.int64), points - 1)
+    _, starts = np.unique(buckets, return_index=True)
+    return starts
+
+
+def downsample(rows: list[tuple[datetime, int]], points: int, method: str = 'lttb') -> dict:
+    x, y = to_arrays(rows)
+
+    if len(x) == 0:
+        return {'method': method, 'time': [], 'value': []}
+
+    series = {}
+
+    if method == 'lttb':
+        indices = lttb(x, y, points)
+        x, y = x[indices], y[indices]
+    else:
+        starts = bucket_starts(x, points)
+        counts = np.diff(np.append(starts, len(x)))
+        if method == 'minmax':
+            series['min'] = np.minimum.reduceat(y, starts).tolist()
+            series['max'] = np.maximum.reduceat(y, starts).tolist()
+        y = np.add.reduceat(y, starts) / counts
+        x = x[starts]
+
+    return {
+        'method': method,
+        'time': x.astype('datetime64[s]').astype(str).tolist(),
+        'value': y.tolist(),
+    } | series
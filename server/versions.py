@@ -0,0 +1,141 @@
+from fastapi.responses import Response
+from database import open_async_db_session
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from presence import presence
+from models import Device
+from sqlalchemy import select
+import threading
+import hashlib
+import json
+import time
+
+
+RESPONSE_CACHE_SIZE = 64
+
+# Views are revalidated on every request, but only re-rendered when a version they depend on changed
+
+
+class VersionTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Versions restart from 0, so the epoch keeps ETags from a previous run from matching
+        self.epoch = f'{time.time_ns():x}'
+        self.fleet = 0
+        self.devices: dict[int, int] = {}
+        self.snapshot: dict[int, tuple[int, datetime]] | None = None
+        self.snapshot_version = -1
+        # Changes made here that other workers still have to hear about, sent on by the broker.
+        # Only collected when there are other workers, a single one would pay a write per change for nothing.
+        self.shared = False
+        self.outbox: set[tuple[str, int | None, str | None]] = set()
+
+    def device(self, device_id: int) -> int:
+        return self.devices.get(device_id, 0)
+
+    def device_changed(self, device_id: int, local: bool = False):
+        # Device row itself changed, which is visible in the device list as well
+        with self.lock:
+            self.devices[device_id] = self.devices.get(device_id, 0) + 1
+            self.fleet += 1
+            if self.shared and not local:
+                self.outbox.add(('device', device_id, None))
+
+    def readings_changed(self, device_id: int, local: bool = False, event: tuple[str, dict] | None = None):
+        # Event is what subscribers of this worker got, image links and archiving do not send any
+        with self.lock:
+            self.devices[device_id] = self.devices.get(device_id, 0) + 1
+            if self.shared and not local:
+                payload = json.dumps({'event': event[0], 'data': event[1]}) if event else None
+                self.outbox.add(('readings', device_id, payload))
+
+    def expire_snapshot(self):
+        with self.lock:
+            self.snapshot_version = -1
+
+    def drain_outbox(self) -> set[tuple[str, int | None, str | None]]:
+        with self.lock:
+            outbox, self.outbox = self.outbox, set()
+        return outbox
+
+    def requeue_outbox(self, changes: set[tuple[str, int | None, str | None]]):
+        # Sent again with the next batch, unless the same change is already waiting there
+        with self.lock:
+            self.outbox |= changes
+
+    async def fleet_snapshot(self) -> dict[int, tuple[int, datetime]]:
+        # Online timeout and stored last online time of every device, enough to tell statuses without a query
+        with self.lock:
+            if self.snapshot_version == self.fleet:
+                return self.snapshot
+            version = self.fleet
+
+        async with open_async_db_session() as session:
+            stmt = select(Device.id, Device.online_timeout_sec, Device.last_online_time)
+            snapshot = {row.id: (row.online_timeout_sec, row.last_online_time) for row in await session.execute(stmt)}
+
+        with self.lock:
+            if version == self.fleet:
+                self.snapshot, self.snapshot_version = snapshot, version
+
+        return snapshot
+
+    def etag(self, *parts) -> str:
+        digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+        return f'W/"{self.epoch}-{digest}"'
+
+
+def last_seen(device_id: int, snapshot: dict[int, tuple[int, datetime]]) -> datetime:
+    return presence.latest(device_id, snapshot[device_id][1])
+
+
+def snapshot_statuses(snapshot: dict[int, tuple[int, datetime]]) -> dict[int, bool]:
+    now = datetime.now()
+    return {
+        device_id: now - last_seen(device_id, snapshot) <= timedelta(seconds=online_timeout_sec)
+        for device_id, (online_timeout_sec, _) in snapshot.items()
+    }
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or etag.removeprefix('W/') in tags
+
+
+class ResponseCache:
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.entries: OrderedDict[str, tuple[bytes, str]] = OrderedDict()
+
+    def headers(self, etag: str) -> dict[str, str]:
+        return {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    def lookup(self, request, etag: str) -> Response | None:
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=self.headers(etag))
+
+        with self.lock:
+            if etag not in self.entries:
+                return None
+            self.entries.move_to_end(etag)
+            body, media_type = self.entries[etag]
+
+        return Response(body, media_type=media_type, headers=self.headers(etag))
+
+    def store(self, etag: str, response: Response) -> Response:
+        response.headers.update(self.headers(etag))
+
+        with self.lock:
+            self.entries[etag] = (response.body, response.media_type)
+            self.entries.move_to_end(etag)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return response
+
+
+versions = VersionTracker()
+response_cache = ResponseCache()
@@ -0,0 +1,60 @@
+from database import open_async_db_session
+from typing import Any, Callable
+from sqlalchemy.orm import Session
+from log import logger
+import asyncio
+
+
+WRITER_MAX_BATCH = 256
+
+
+class WriteQueue:
+    def __init__(self):
+        self.queue: asyncio.Queue | None = None
+
+    async def submit(self, operation: Callable[[Session], Any]) -> Any:
+        if self.queue is None:
+            raise RuntimeError('Write queue is not running')
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((operation, future))
+        return await future
+
+    async def execute(self, batch: list[tuple[Callable[[Session], Any], asyncio.Future]]):
+        async with open_async_db_session() as session:
+            try:
+                results = [await session.run_sync(operation) for operation, _ in batch]
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    return
+                # One operation failed the group, so fall back to a transaction per operation to isolate it
+                for item in batch:
+                    await self.execute([item])
+                return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < WRITER_MAX_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await self.execute(batch)
+            except Exception as e:
+                logger.error(f'Writer failed: {e!r}')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+writer = WriteQueue()